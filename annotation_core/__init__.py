@@ -0,0 +1,8 @@
+from .diff import ChangeSet, diff_points, apply_changes
+from .ops import apply_ops
+from .point_store import PointStore
+from .journal import AnnotationJournal, open_journal, close_journal
+from .sqlite_store import AnnotationDatabase, open_database
+from .persistence import PersistenceService, get_persistence_service
+from .render import OverlayRenderer, render_points, stamp_points
+from .image_store import ImageStore, shard_path
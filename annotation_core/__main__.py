@@ -0,0 +1,16 @@
+import argparse
+from pathlib import Path
+
+from .sqlite_store import open_database
+
+parser = argparse.ArgumentParser(description="Import the CSV/TXT annotation tree of the annotators into SQLite.")
+parser.add_argument("data_dirs", nargs="+", metavar="ANNOTATOR=DATA_DIR",
+                    help="e.g. her2=her2_annotator/data ki67=ki67_annotator/data")
+parser.add_argument("--db", default=None, help="Database path (default: ANNOTATION_DB or data/annotations.sqlite3)")
+args = parser.parse_args()
+
+database = open_database(args.db)
+for item in args.data_dirs:
+    annotator, data_dir = item.split("=", 1)
+    count = database.import_csv_tree(annotator, Path(data_dir) / "annotations", Path(data_dir) / "reports")
+    print(f"{annotator}: {count} images imported")
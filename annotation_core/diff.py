@@ -0,0 +1,111 @@
+from dataclasses import dataclass, field
+
+import numpy as np
+
+
+@dataclass
+class ChangeSet:
+    """
+    Delta between a PointStore and a patch returned by `pointdet`.
+
+    Attributes:
+        added (list): Tuples (point_id, x, y, label_id) of points that are
+            new. `point_id` is None when the store should allocate one.
+        removed (list): Ids of stored points missing from the patch.
+        moved (list): Tuples (point_id, x, y) of points whose position changed.
+        relabeled (list): Tuples (point_id, label_id) of points whose label
+            changed.
+    """
+    added: list = field(default_factory=list)
+    removed: list = field(default_factory=list)
+    moved: list = field(default_factory=list)
+    relabeled: list = field(default_factory=list)
+
+    def __bool__(self):
+        return bool(self.added or self.removed or self.moved or self.relabeled)
+
+
+def _pack(xs, ys):
+    """
+    Packs integer coordinates into a single int64 key per point.
+    """
+    return (xs.astype(np.int64) << 32) | (ys.astype(np.int64) & 0xFFFFFFFF)
+
+
+def diff_points(new_labels, store):
+    """
+    Computes the change-set between a PointStore and the patch returned by
+    `pointdet`. The patch is keyed once (by the stable point `id` when the
+    component sends it, otherwise by integer coordinates) and matched against
+    the store with sorted array lookups, without nested loops.
+
+    Args:
+        new_labels (list): Items returned by `pointdet`, each with a `point`
+            [x, y], a `label_id` and optionally an `id`.
+        store (PointStore): The stored points.
+
+    Returns:
+        ChangeSet: The added, removed, moved and relabeled points.
+    """
+    changes = ChangeSet()
+
+    with_ids = len(new_labels) > 0 and all(v.get('id') is not None for v in new_labels)
+    patch = np.array([(*v['point'], v['label_id']) for v in new_labels], dtype=np.float64).reshape(-1, 3)
+    px = patch[:, 0].astype(np.int64)  # Coordinates are truncated to pixels
+    py = patch[:, 1].astype(np.int64)
+    pl = patch[:, 2].astype(np.int64)
+
+    ids, sx, sy, sl = store.columns()
+    if with_ids:
+        pk = np.array([v['id'] for v in new_labels], dtype=np.int64)
+        sk = ids
+    else:
+        # Without ids, two patch points on the same pixel are the same point
+        pk = _pack(px, py)
+        sk = _pack(sx, sy)
+
+    pk, first = np.unique(pk, return_index=True)
+    px, py, pl = px[first], py[first], pl[first]
+
+    order = np.argsort(sk, kind='stable')
+    sk_sorted = sk[order]
+
+    pos = np.searchsorted(sk_sorted, pk)
+    pos = np.minimum(pos, max(len(sk_sorted) - 1, 0))
+    found = (sk_sorted[pos] == pk) if len(sk_sorted) else np.zeros(len(pk), dtype=bool)
+
+    new = ~found
+    new_ids = pk[new].tolist() if with_ids else [None] * int(new.sum())
+    changes.added = list(zip(new_ids, px[new].tolist(), py[new].tolist(), pl[new].tolist()))
+
+    rows = order[pos[found]]
+    moved = (sx[rows] != px[found]) | (sy[rows] != py[found])
+    changes.moved = list(zip(ids[rows][moved].tolist(), px[found][moved].tolist(), py[found][moved].tolist()))
+
+    relabeled = sl[rows] != pl[found]
+    changes.relabeled = list(zip(ids[rows][relabeled].tolist(), pl[found][relabeled].tolist()))
+
+    changes.removed = ids[~np.isin(sk, pk)].tolist()
+
+    return changes
+
+
+def apply_changes(changes, store):
+    """
+    Applies a change-set to a PointStore in place. The ids allocated by the
+    store for added points without one are written back into `changes`, so
+    the change-set can be journaled afterwards.
+    """
+    for point_id in changes.removed:
+        store.delete(point_id)
+
+    changes.added = [
+        (store.add(x, y, label_id, point_id), x, y, label_id)
+        for point_id, x, y, label_id in changes.added
+    ]
+
+    for point_id, x, y in changes.moved:
+        store.move(point_id, x, y)
+
+    for point_id, label_id in changes.relabeled:
+        store.relabel(point_id, label_id)
@@ -0,0 +1,205 @@
+import json
+import os
+import threading
+
+from .uploads import copy_upload, file_sha256
+
+
+def shard_path(folder, key, suffix=""):
+    """
+    Path of the file of `key` with `suffix` in `folder`, two levels of
+    subfolders deep (`ab/cd/abcd...`), so no folder grows with the number
+    of images.
+    """
+    return os.path.join(str(folder), key[:2], key[2:4], key + suffix)
+
+
+class ImageStore:
+    """
+    Images stored by the SHA-256 of their contents.
+
+    Each image is stored once, as `<ab>/<cd>/<sha256><extension>` (see
+    `shard_path`), whatever the name it was uploaded with, and is identified
+    by its hash (its key) everywhere else: annotations, reports and
+    derivatives. A manifest records the key of every uploaded name and the
+    file and last name of every key, with the images in the order they were
+    last uploaded, so images are found by name or by key, and the most
+    recent ones listed, without hashing, listing or stating the folder.
+
+    The manifest is a small JSON file, rewritten atomically on every change
+    and held in memory. It is only read again when the file changes on
+    disk, which is checked with a single stat per lookup, so the stores of
+    other processes stay in sync.
+
+    Args:
+        image_dir (str): Folder of the images.
+        manifest_path (str): Path of the manifest.
+    """
+
+    def __init__(self, image_dir, manifest_path):
+        self.image_dir = str(image_dir)
+        self.manifest_path = str(manifest_path)
+        self._lock = threading.Lock()
+        self._manifest = None
+        self._stamp = None  # (mtime_ns, size) of the manifest as last read or written
+        self._adopted = False
+
+    def _manifest_stamp(self):
+        try:
+            stat = os.stat(self.manifest_path)
+        except FileNotFoundError:
+            return None
+        return (stat.st_mtime_ns, stat.st_size)
+
+    def _load_locked(self):
+        stamp = self._manifest_stamp()
+        if self._manifest is None or stamp != self._stamp:
+            try:
+                with open(self.manifest_path, "r", encoding="utf-8") as manifest_file:
+                    self._manifest = json.load(manifest_file)
+            except FileNotFoundError:
+                self._manifest = {"names": {}, "images": {}}
+            self._stamp = stamp
+        return self._manifest
+
+    def _save_locked(self):
+        os.makedirs(os.path.dirname(os.path.abspath(self.manifest_path)), exist_ok=True)
+        tmp_path = f"{self.manifest_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as manifest_file:
+            json.dump(self._manifest, manifest_file)
+        os.replace(tmp_path, self.manifest_path)
+        self._stamp = self._manifest_stamp()
+
+    def _record_locked(self, key, file_name, name):
+        # Images are kept in the order they were last recorded
+        images = self._load_locked()["images"]
+        images.pop(key, None)
+        images[key] = {"file": file_name, "name": name}
+        self._manifest["names"][name] = key
+
+    def add(self, uploaded_file, name):
+        """
+        Stores an uploaded file under its hash, unless the same contents are
+        stored already, records the name it was uploaded with and makes it
+        the most recent image.
+
+        Returns:
+            str: The key of the image.
+        """
+        tmp_path, key = copy_upload(uploaded_file, self.image_dir)
+        file_name = os.path.relpath(shard_path("", key, os.path.splitext(name)[1].lower()))
+        with self._lock:
+            entry = self._load_locked()["images"].get(key)
+            if entry is not None and os.path.exists(os.path.join(self.image_dir, entry["file"])):
+                # Same contents as a stored image: its file, and everything
+                # derived from it, is kept as it is
+                os.remove(tmp_path)
+                file_name = entry["file"]
+            else:
+                path = os.path.join(self.image_dir, file_name)
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                os.replace(tmp_path, path)
+            self._record_locked(key, file_name, name)
+            self._save_locked()
+        return key
+
+    def resolve(self, name_or_key):
+        """
+        Returns the key of a stored image given its key or the last name it
+        was uploaded with, or None.
+        """
+        with self._lock:
+            manifest = self._load_locked()
+            if name_or_key in manifest["images"]:
+                return name_or_key
+            return manifest["names"].get(name_or_key)
+
+    def path(self, key):
+        """
+        Returns the path of the image with the given key, or None.
+        """
+        with self._lock:
+            entry = self._load_locked()["images"].get(key)
+        return None if entry is None else os.path.join(self.image_dir, entry["file"])
+
+    def name(self, key):
+        """
+        Returns the last name the image with the given key was uploaded with,
+        or None.
+        """
+        with self._lock:
+            entry = self._load_locked()["images"].get(key)
+        return None if entry is None else entry["name"]
+
+    def keys(self):
+        """
+        Returns the keys of the stored images, the most recent last.
+        """
+        with self._lock:
+            return list(self._load_locked()["images"])
+
+    def recent(self, count):
+        """
+        Returns the keys of the `count` most recently uploaded images, the
+        most recent first.
+        """
+        with self._lock:
+            images = self._load_locked()["images"]
+            return [key for key, _ in zip(reversed(images), range(count))]
+
+    def remove(self, keys):
+        """
+        Deletes the images with the given keys and forgets them.
+        """
+        keys = set(keys)
+        with self._lock:
+            manifest = self._load_locked()
+            for key in keys:
+                entry = manifest["images"].pop(key, None)
+                if entry is not None:
+                    try:
+                        os.remove(os.path.join(self.image_dir, entry["file"]))
+                    except FileNotFoundError:
+                        pass
+            manifest["names"] = {name: key for name, key in manifest["names"].items() if key not in keys}
+            self._save_locked()
+
+    def adopt_legacy(self):
+        """
+        Moves the images stored at the top of the folder by name, as older
+        versions did, to their sharded content address. The folder is only
+        listed the first time.
+
+        Returns:
+            dict: Key of each adopted image, by its former file name without
+                extension, so its annotations can be moved too.
+        """
+        adopted = {}
+        with self._lock:
+            if self._adopted:
+                return adopted
+            self._adopted = True
+            if not os.path.isdir(self.image_dir):
+                return adopted
+
+            images = self._load_locked()["images"]
+            for file_name in sorted(os.listdir(self.image_dir)):
+                stem, extension = os.path.splitext(file_name)
+                path = os.path.join(self.image_dir, file_name)
+                if file_name.startswith(".") or not os.path.isfile(path):
+                    continue
+                key = file_sha256(path)
+                stored_name = os.path.relpath(shard_path("", key, extension.lower()))
+                stored_path = os.path.join(self.image_dir, stored_name)
+                if os.path.exists(stored_path):
+                    os.remove(path)
+                else:
+                    os.makedirs(os.path.dirname(stored_path), exist_ok=True)
+                    os.replace(path, stored_path)
+                name = images[key]["name"] if key in images else file_name
+                self._record_locked(key, stored_name, name)
+                adopted[stem] = key
+
+            if adopted:
+                self._save_locked()
+        return adopted
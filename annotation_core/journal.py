@@ -0,0 +1,307 @@
+import atexit
+import csv
+import io
+import os
+import threading
+import time
+
+from .ops import apply_ops
+from .point_store import PointStore
+
+
+class AnnotationJournal:
+    """
+    Append-only journal of the edits made to the annotations of one image.
+
+    The annotations of an image are its CSV snapshot (`<name>.csv`, as written
+    by `PointStore.to_csv_bytes`) plus the edits journaled since that snapshot
+    (`<name>.journal`), one record per add, delete, move or relabel. Records
+    are flushed on every append and fsynced in batches. Once enough records
+    pile up, the journal is compacted: it is rotated to `<name>.journal.old`,
+    a new snapshot is built from the previous one and the rotated records and
+    written atomically in a background thread, and the rotated journal is
+    removed. The snapshot comes from the files, not from the points of a
+    session, so it holds the edits of every session. Replaying a record twice
+    is harmless, so a crash at any point of the compaction loses nothing.
+
+    Use `open_journal` to get the journal of a CSV path, which is shared by
+    every session of the process.
+
+    Args:
+        csv_path (str): Path of the CSV snapshot.
+        label_list (list): Names of the labels, indexed by label code.
+        fsync_every (int, optional): Records written between fsyncs.
+        fsync_interval (float, optional): Seconds between fsyncs.
+        compact_every (int, optional): Records that trigger a compaction.
+    """
+
+    def __init__(self, csv_path, label_list, fsync_every=64, fsync_interval=1.0, compact_every=2000):
+        self.csv_path = str(csv_path)
+        self.path = os.path.splitext(self.csv_path)[0] + ".journal"
+        self.old_path = self.path + ".old"
+        self.label_list = list(label_list)
+        self.fsync_every = fsync_every
+        self.fsync_interval = fsync_interval
+        self.compact_every = compact_every
+
+        self._lock = threading.Lock()
+        self._file = None
+        self._unsynced = 0
+        self._last_sync = time.monotonic()
+        self._records = 0
+        self._compaction = None
+        self._next_id = None  # First point id not reserved yet
+
+    def _is_open_locked(self):
+        """
+        Whether the open file is still the one at `path`, which is not the
+        case once the journal was deleted or replaced by another process.
+        """
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return False
+        opened = os.fstat(self._file.fileno())
+        return (stat.st_dev, stat.st_ino) == (opened.st_dev, opened.st_ino)
+
+    def _open(self):
+        if self._file is not None and not self._is_open_locked():
+            # Records appended to a deleted file would be lost
+            self._close_locked()
+        if self._file is None:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            self._file = open(self.path, "a", encoding="utf-8", newline="")
+
+            # Terminate a record torn by a crash, so that it stays on its own line
+            if self._file.tell() > 0:
+                with open(self.path, "rb") as journal_file:
+                    journal_file.seek(-1, os.SEEK_END)
+                    if journal_file.read(1) != b"\n":
+                        self._file.write("\n")
+        return self._file
+
+    def _sync_locked(self):
+        if self._file is not None and self._unsynced:
+            self._file.flush()
+            os.fsync(self._file.fileno())
+        self._unsynced = 0
+        self._last_sync = time.monotonic()
+
+    def _close_locked(self):
+        if self._file is not None:
+            self._sync_locked()
+            self._file.close()
+            self._file = None
+
+    def append(self, changes):
+        """
+        Journals a change-set, whose added points must all have their id. When
+        enough records have been written since the last snapshot, a compaction
+        is started.
+        """
+        if not changes:
+            return
+
+        buffer = io.StringIO()
+        writer = csv.writer(buffer, lineterminator="\n")
+        for point_id in changes.removed:
+            writer.writerow(["d", point_id])
+        for point_id, x, y, label_id in changes.added:
+            writer.writerow(["a", point_id, x, y, self.label_list[label_id]])
+        for point_id, x, y in changes.moved:
+            writer.writerow(["m", point_id, x, y])
+        for point_id, label_id in changes.relabeled:
+            writer.writerow(["r", point_id, self.label_list[label_id]])
+        records = buffer.getvalue()
+        count = records.count("\n")
+
+        with self._lock:
+            journal_file = self._open()
+            journal_file.write(records)
+            journal_file.flush()
+
+            self._unsynced += count
+            self._records += count
+            if self._next_id is not None and changes.added:
+                # Ids not reserved here (e.g. chosen by the caller) are not reserved again
+                self._next_id = max(self._next_id, max(point_id for point_id, *_ in changes.added) + 1)
+            if self._unsynced >= self.fsync_every or time.monotonic() - self._last_sync >= self.fsync_interval:
+                self._sync_locked()
+
+        if self._records >= self.compact_every:
+            self.compact()
+
+    def sync(self):
+        """
+        Forces the journaled records to disk.
+        """
+        with self._lock:
+            self._sync_locked()
+
+    def _read_ops(self, path):
+        ops = []
+        try:
+            with open(path, "r", encoding="utf-8", newline="") as journal_file:
+                for row in csv.reader(journal_file):
+                    try:
+                        kind = row[0]
+                        if kind == "a":
+                            ops.append({'op': 'add', 'id': int(row[1]), 'point': [int(row[2]), int(row[3])], 'label_id': self.label_list.index(row[4])})
+                        elif kind == "d":
+                            ops.append({'op': 'delete', 'id': int(row[1])})
+                        elif kind == "m":
+                            ops.append({'op': 'move', 'id': int(row[1]), 'point': [int(row[2]), int(row[3])]})
+                        elif kind == "r":
+                            ops.append({'op': 'relabel', 'id': int(row[1]), 'label_id': self.label_list.index(row[2])})
+                    except (IndexError, ValueError):
+                        # Torn record left by a crash mid-write
+                        continue
+        except FileNotFoundError:
+            pass
+        return ops
+
+    def _read_snapshot(self, store):
+        try:
+            with open(self.csv_path, "r", encoding="utf-8", newline="") as csv_file:
+                for row in csv.DictReader(csv_file):
+                    # The stable point Id is missing in older files
+                    point_id = int(row["Id"]) if row.get("Id") else None
+                    store.add(int(row["X"]), int(row["Y"]), self.label_list.index(row["Label"]), point_id)
+        except FileNotFoundError:
+            # No snapshot yet: the points are all in the journal
+            pass
+
+    def load(self, store):
+        """
+        Loads the CSV snapshot into an empty PointStore and replays the
+        records journaled since it was written. Returns the number of records
+        replayed. Both are read under the lock of the journal, so a compaction
+        finishing meanwhile cannot replace the snapshot between the two reads.
+        """
+        with self._lock:
+            self._sync_locked()
+            self._read_snapshot(store)
+            ops = self._read_ops(self.old_path) + self._read_ops(self.path)
+            self._records = len(ops)
+        apply_ops(ops, store)
+        return len(ops)
+
+    def reserve_ids(self, count):
+        """
+        Reserves `count` consecutive point ids and returns the first one. The
+        ids start above every point of the snapshot and the journal, and the
+        journal is shared by the sessions of the process (see `open_journal`),
+        so the ids reserved for different sessions never overlap.
+        """
+        with self._lock:
+            if self._next_id is None:
+                snapshot = PointStore(self.label_list)
+                self._read_snapshot(snapshot)
+                ops = self._read_ops(self.old_path) + self._read_ops(self.path)
+                ids = snapshot.columns()[0].tolist() + [op['id'] for op in ops]
+                self._next_id = max(ids, default=0) + 1
+            first = self._next_id
+            self._next_id += count
+        return first
+
+    def replay(self, store):
+        """
+        Applies the journaled records to a PointStore loaded from the CSV
+        snapshot and returns the number of records replayed.
+        """
+        with self._lock:
+            self._sync_locked()
+            ops = self._read_ops(self.old_path) + self._read_ops(self.path)
+            self._records = len(ops)
+        apply_ops(ops, store)
+        return len(ops)
+
+    def compact(self, background=True):
+        """
+        Writes a new CSV snapshot with the records journaled so far and drops
+        them.
+        """
+        with self._lock:
+            if self._compaction is not None and self._compaction.is_alive():
+                return
+            self._close_locked()
+
+            if os.path.exists(self.path):
+                if os.path.exists(self.old_path):
+                    # A previous compaction did not finish: keep its records
+                    with open(self.path, "r", encoding="utf-8", newline="") as src, \
+                            open(self.old_path, "a", encoding="utf-8", newline="") as dst:
+                        dst.write(src.read())
+                    os.remove(self.path)
+                else:
+                    os.replace(self.path, self.old_path)
+            self._records = 0
+
+            self._compaction = threading.Thread(target=self._write_snapshot, daemon=True)
+            self._compaction.start()
+
+        if not background:
+            self._compaction.join()
+
+    def _write_snapshot(self):
+        # Only the compaction writes the snapshot and the rotated journal,
+        # so they are read without the lock
+        snapshot = PointStore(self.label_list)
+        self._read_snapshot(snapshot)
+        apply_ops(self._read_ops(self.old_path), snapshot)
+
+        tmp_path = self.csv_path + ".tmp"
+        with open(tmp_path, "wb") as csv_file:
+            csv_file.write(snapshot.to_csv_bytes())
+            csv_file.flush()
+            os.fsync(csv_file.fileno())
+
+        # Swapped under the lock, so `load` sees either the old snapshot
+        # with the rotated records or the new one without them
+        with self._lock:
+            os.replace(tmp_path, self.csv_path)
+            try:
+                os.remove(self.old_path)
+            except FileNotFoundError:
+                pass
+
+    def close(self):
+        if self._compaction is not None:
+            self._compaction.join()
+        with self._lock:
+            self._close_locked()
+
+
+_journals = {}
+_journals_lock = threading.Lock()
+
+
+def open_journal(csv_path, label_list):
+    """
+    Returns the process-wide journal of the given CSV snapshot path.
+    """
+    key = os.path.abspath(csv_path)
+    with _journals_lock:
+        if key not in _journals:
+            _journals[key] = AnnotationJournal(csv_path, label_list)
+        return _journals[key]
+
+
+def close_journal(csv_path):
+    """
+    Closes the journal of the given CSV snapshot path, if it is open, and
+    forgets it. Call it before deleting the files of the journal, so no
+    session keeps appending to a deleted file.
+    """
+    key = os.path.abspath(csv_path)
+    with _journals_lock:
+        journal = _journals.pop(key, None)
+    if journal is not None:
+        journal.close()
+
+
+@atexit.register
+def _close_journals():
+    with _journals_lock:
+        for journal in _journals.values():
+            journal.close()
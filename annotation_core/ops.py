@@ -0,0 +1,67 @@
+from .diff import ChangeSet
+
+
+def apply_ops(ops, store):
+    """
+    Applies the ops returned by `pointdet` to a PointStore, in order, and
+    coalesces them into a change-set (e.g. a point added and deleted within
+    the same batch does not appear at all).
+
+    Ops on unknown ids are ignored, and an `add` of an id that is already
+    stored updates that point, so replayed ops are harmless.
+
+    Args:
+        ops (list): Ops in full-resolution coordinates, each with an `op`
+            ('add', 'move', 'delete' or 'relabel'), the point `id` and, as
+            needed, its `point` [x, y] and `label_id`.
+        store (PointStore): The stored points.
+
+    Returns:
+        ChangeSet: The added, removed, moved and relabeled points.
+    """
+    added = {}
+    removed = []
+    moved = {}
+    relabeled = {}
+
+    for op in ops:
+        kind = op['op']
+        point_id = int(op['id'])
+        if 'point' in op:
+            x, y = (int(b) for b in op['point'])  # Coordinates are truncated to pixels
+
+        if kind == 'add' and point_id not in store:
+            store.add(x, y, op['label_id'], point_id)
+            added[point_id] = [x, y, op['label_id']]
+            continue
+
+        if point_id not in store:
+            continue
+
+        if kind in ('add', 'move'):
+            store.move(point_id, x, y)
+            if point_id in added:
+                added[point_id][:2] = [x, y]
+            else:
+                moved[point_id] = (x, y)
+
+        if kind in ('add', 'relabel'):
+            store.relabel(point_id, op['label_id'])
+            if point_id in added:
+                added[point_id][2] = op['label_id']
+            else:
+                relabeled[point_id] = op['label_id']
+
+        if kind == 'delete':
+            store.delete(point_id)
+            if added.pop(point_id, None) is None:
+                removed.append(point_id)
+                moved.pop(point_id, None)
+                relabeled.pop(point_id, None)
+
+    return ChangeSet(
+        added=[(point_id, *values) for point_id, values in added.items()],
+        removed=removed,
+        moved=[(point_id, *position) for point_id, position in moved.items()],
+        relabeled=list(relabeled.items()),
+    )
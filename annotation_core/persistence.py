@@ -0,0 +1,111 @@
+import atexit
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+
+class PersistenceService:
+    """
+    Runs the snapshot jobs of the annotators (report files, download
+    artifacts, annotated image) in background threads.
+
+    Jobs are identified by a tuple key. Jobs with the same key run one at a
+    time and in order; a job submitted while another one with its key is
+    still waiting replaces it, since only the latest snapshot matters.
+
+    Use `get_persistence_service` to get the service shared by every session
+    of the process.
+
+    Args:
+        max_workers (int, optional): Number of writer threads.
+    """
+
+    def __init__(self, max_workers=2):
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="persistence")
+        self._cond = threading.Condition()
+        self._waiting = {}     # Key -> (fn, args) of the job to run next
+        self._scheduled = set()  # Keys with a job waiting or running
+        self._failed = set()
+
+    def submit(self, key, fn, *args):
+        """
+        Schedules `fn(*args)`, replacing the job of `key` not started yet.
+        """
+        with self._cond:
+            self._waiting[key] = (fn, args)
+            if key in self._scheduled:
+                return
+            self._scheduled.add(key)
+        self._executor.submit(self._run, key)
+
+    def _run(self, key):
+        while True:
+            with self._cond:
+                job = self._waiting.pop(key, None)
+                if job is None:
+                    self._scheduled.discard(key)
+                    self._cond.notify_all()
+                    return
+
+            fn, args = job
+            try:
+                fn(*args)
+            except Exception:
+                print(f"Error in persistence job {key}:\n{traceback.format_exc()}")
+                with self._cond:
+                    self._failed.add(key)
+            else:
+                with self._cond:
+                    self._failed.discard(key)
+
+    def _matching(self, keys, prefix):
+        return [key for key in keys if key[:len(prefix)] == prefix]
+
+    def busy(self, *prefix):
+        """
+        Returns True while a job whose key starts with `prefix` is waiting or
+        running.
+        """
+        with self._cond:
+            return bool(self._matching(self._scheduled, prefix))
+
+    def failed(self, *prefix):
+        """
+        Returns True if the last job of a key starting with `prefix` failed.
+        """
+        with self._cond:
+            return bool(self._matching(self._failed, prefix))
+
+    def flush(self, *prefix, timeout=None):
+        """
+        Waits until the jobs whose key starts with `prefix` are done. Returns
+        False on timeout.
+        """
+        with self._cond:
+            return self._cond.wait_for(lambda: not self._matching(self._scheduled, prefix), timeout)
+
+    def shutdown(self):
+        self.flush()
+        self._executor.shutdown(wait=True)
+
+
+_service = None
+_service_lock = threading.Lock()
+
+
+def get_persistence_service():
+    """
+    Returns the process-wide persistence service.
+    """
+    global _service
+    with _service_lock:
+        if _service is None:
+            _service = PersistenceService()
+        return _service
+
+
+@atexit.register
+def _shutdown_service():
+    with _service_lock:
+        if _service is not None:
+            _service.shutdown()
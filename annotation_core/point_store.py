@@ -0,0 +1,210 @@
+import csv
+import io
+
+import numpy as np
+
+
+class PointStore:
+    """
+    Columnar storage of the annotated points of one image.
+
+    Points live in contiguous NumPy arrays (x, y, label code, stable id and a
+    tombstone flag) so that appending and deleting are O(1) and aggregate
+    queries run vectorised. Deleted rows are tombstoned and squeezed out once
+    they outnumber the live ones. `version` increases on every mutation.
+
+    Args:
+        label_list (list): Names of the labels, indexed by label code.
+        capacity (int, optional): Initial number of allocated rows.
+    """
+
+    def __init__(self, label_list, capacity=256):
+        self.label_list = list(label_list)
+        self.version = 0
+
+        self._x = np.zeros(capacity, dtype=np.int32)
+        self._y = np.zeros(capacity, dtype=np.int32)
+        self._label = np.zeros(capacity, dtype=np.int16)
+        self._id = np.zeros(capacity, dtype=np.int64)
+        self._alive = np.zeros(capacity, dtype=bool)
+
+        self._size = 0      # Rows in use, including tombstones
+        self._count = 0     # Live rows
+        self._rows = {}     # Point id -> row
+        self._next_id = 1
+
+    def __len__(self):
+        return self._count
+
+    def __contains__(self, point_id):
+        return point_id in self._rows
+
+    def _grow(self, needed):
+        capacity = len(self._x)
+        if needed <= capacity:
+            return
+        # Empty stores and their copies have no rows to double
+        capacity = max(capacity, 1)
+        while capacity < needed:
+            capacity *= 2
+        for name in ('_x', '_y', '_label', '_id', '_alive'):
+            old = getattr(self, name)
+            new = np.zeros(capacity, dtype=old.dtype)
+            new[:self._size] = old[:self._size]
+            setattr(self, name, new)
+
+    def _compact(self):
+        keep = np.flatnonzero(self._alive[:self._size])
+        for name in ('_x', '_y', '_label', '_id', '_alive'):
+            column = getattr(self, name)
+            column[:len(keep)] = column[keep]
+        self._alive[len(keep):self._size] = False
+        self._size = len(keep)
+        self._rows = dict(zip(self._id[:self._size].tolist(), range(self._size)))
+
+    def add(self, x, y, label_id, point_id=None):
+        """
+        Appends a point and returns its id. A new id is allocated when
+        `point_id` is None.
+        """
+        if point_id is None:
+            point_id = self._next_id
+        point_id = int(point_id)
+        if point_id in self._rows:
+            raise KeyError(f"Point id {point_id} already exists")
+        self._next_id = max(self._next_id, point_id + 1)
+
+        self._grow(self._size + 1)
+        row = self._size
+        self._x[row] = x
+        self._y[row] = y
+        self._label[row] = label_id
+        self._id[row] = point_id
+        self._alive[row] = True
+
+        self._rows[point_id] = row
+        self._size += 1
+        self._count += 1
+        self.version += 1
+        return point_id
+
+    def extend(self, xs, ys, label_ids):
+        """
+        Appends several points at once and returns their new ids.
+        """
+        xs = np.asarray(xs, dtype=np.int32)
+        n = len(xs)
+        ids = np.arange(self._next_id, self._next_id + n, dtype=np.int64)
+
+        self._grow(self._size + n)
+        rows = slice(self._size, self._size + n)
+        self._x[rows] = xs
+        self._y[rows] = np.asarray(ys, dtype=np.int32)
+        self._label[rows] = np.asarray(label_ids, dtype=np.int16)
+        self._id[rows] = ids
+        self._alive[rows] = True
+
+        self._rows.update(zip(ids.tolist(), range(self._size, self._size + n)))
+        self._next_id += n
+        self._size += n
+        self._count += n
+        self.version += 1
+        return ids
+
+    def delete(self, point_id):
+        """
+        Tombstones a point. Returns False if the id is unknown.
+        """
+        row = self._rows.pop(point_id, None)
+        if row is None:
+            return False
+
+        self._alive[row] = False
+        self._count -= 1
+        self.version += 1
+
+        # Squeeze tombstones out once they dominate the arrays
+        if self._size > 64 and self._count < self._size // 2:
+            self._compact()
+        return True
+
+    def move(self, point_id, x, y):
+        row = self._rows[point_id]
+        self._x[row] = x
+        self._y[row] = y
+        self.version += 1
+
+    def relabel(self, point_id, label_id):
+        row = self._rows[point_id]
+        self._label[row] = label_id
+        self.version += 1
+
+    def copy(self):
+        """
+        Returns an independent copy of the store.
+        """
+        other = PointStore.__new__(PointStore)
+        other.__dict__.update(self.__dict__)
+        for name in ('_x', '_y', '_label', '_id', '_alive'):
+            setattr(other, name, getattr(self, name)[:self._size].copy())
+        other._rows = dict(self._rows)
+        return other
+
+    def get(self, point_id):
+        """
+        Returns the (x, y, label_id) of a point.
+        """
+        row = self._rows[point_id]
+        return int(self._x[row]), int(self._y[row]), int(self._label[row])
+
+    def columns(self):
+        """
+        Returns the live (ids, xs, ys, label_ids) arrays, in insertion order.
+        """
+        alive = self._alive[:self._size]
+        return (
+            self._id[:self._size][alive],
+            self._x[:self._size][alive],
+            self._y[:self._size][alive],
+            self._label[:self._size][alive],
+        )
+
+    def counts_by_label(self):
+        """
+        Returns the number of points of each label, indexed by label code.
+        """
+        labels = self._label[:self._size][self._alive[:self._size]]
+        return np.bincount(labels, minlength=len(self.label_list))
+
+    def to_csv_bytes(self):
+        """
+        Returns the points as the `X,Y,Label,Id` CSV stored in ANN_DIR.
+        """
+        ids, xs, ys, labels = self.columns()
+
+        # Quote the label names once, as csv.writer would
+        names_buffer = io.StringIO()
+        csv.writer(names_buffer, lineterminator='\n').writerows([name] for name in self.label_list)
+        names = np.array(names_buffer.getvalue().splitlines() or [''])
+
+        rows = np.char.add(np.char.add(xs.astype(str), ','), ys.astype(str))
+        rows = np.char.add(np.char.add(rows, ','), names[labels])
+        rows = np.char.add(np.char.add(rows, ','), ids.astype(str))
+
+        lines = ["X,Y,Label,Id"] + rows.tolist()
+        return ("\r\n".join(lines) + "\r\n").encode('utf-8')
+
+    def as_payload(self, scale=1.0):
+        """
+        Returns the `points_info` list sent to `pointdet`, with coordinates
+        divided by the display `scale` and the stable id of every point.
+        """
+        ids, xs, ys, labels = self.columns()
+        xs = (xs / scale).tolist()
+        ys = (ys / scale).tolist()
+
+        label_list = self.label_list
+        return [
+            {'point': [x, y], 'label_id': label_id, 'label': label_list[label_id], 'id': point_id}
+            for x, y, label_id, point_id in zip(xs, ys, labels.tolist(), ids.tolist())
+        ]
@@ -0,0 +1,276 @@
+import functools
+import math
+
+import numpy as np
+from PIL import Image, ImageDraw
+
+# Above this many changed points, redrawing the whole layer is cheaper
+MAX_DIRTY_BOXES = 64
+
+# Points stamped per vectorised batch, to bound the memory of the index arrays
+STAMP_BATCH = 4096
+
+# Rings of up to this many pixels are scattered in vectorised batches; the
+# larger ones are copied one by one through their mask, which costs less than
+# computing and writing an index per pixel
+SCATTER_MAX_PIXELS = 384
+
+
+@functools.lru_cache(maxsize=32)
+def ring_sprite(radius, width):
+    """
+    Rasterises the ring drawn around a point, exactly as PIL's
+    `ImageDraw.ellipse` draws it around an integer position.
+
+    Returns:
+        tuple: (dy, dx) arrays with the offsets of the ring pixels.
+    """
+    pad = int(math.ceil(radius)) + 1
+    sprite = Image.new("L", (2 * pad + 1, 2 * pad + 1), 0)
+    ImageDraw.Draw(sprite).ellipse(
+        [(pad - radius, pad - radius), (pad + radius, pad + radius)],
+        outline=255,
+        width=width,
+    )
+    dy, dx = np.nonzero(np.asarray(sprite))
+    return dy - pad, dx - pad
+
+
+@functools.lru_cache(maxsize=32)
+def ring_mask(radius, width):
+    """
+    Returns the ring of `ring_sprite` as a boolean (2 * pad + 1) square mask,
+    centered on the point.
+    """
+    dy, dx = ring_sprite(radius, width)
+    pad = int(math.ceil(radius)) + 1
+    mask = np.zeros((2 * pad + 1, 2 * pad + 1), dtype=bool)
+    mask[dy + pad, dx + pad] = True
+    return mask
+
+
+def _scatter_rings(pixels, bx, by, colors, ring_offsets, width_px):
+    """
+    Writes whole rings in vectorised batches, one packed RGBA word per pixel.
+    """
+    for batch_start in range(0, len(bx), STAMP_BATCH):
+        batch = slice(batch_start, batch_start + STAMP_BATCH)
+        # With repeated indices the last assignment wins, i.e. the last point
+        pixels[(by[batch] * width_px + bx[batch])[:, None] + ring_offsets] = colors[batch, None]
+
+
+def _blit_rings(pixels, bx, by, colors, mask, width_px):
+    """
+    Copies whole rings one by one into the slice of the buffer around their
+    point, through the mask of the ring.
+    """
+    pad = len(mask) // 2
+    rows = pixels.reshape(-1, width_px)
+    for x, y, color in zip(bx.tolist(), by.tolist(), colors.tolist()):
+        rows[y - pad:y + pad + 1, x - pad:x + pad + 1][mask] = color
+
+
+def label_palette(label_colors, labels, channels=3):
+    """
+    Returns an array with the color of every label code up to the largest
+    one in `labels`, white for the labels missing from `label_colors`.
+    """
+    size = max(int(labels.max()) + 1 if len(labels) else 0, max(label_colors, default=-1) + 1)
+    palette = np.full((size, channels), 255, dtype=np.uint8)
+    for label, color in label_colors.items():
+        palette[label, :3] = color
+    return palette
+
+
+def _ring_pixels(x, y, radius, width):
+    """
+    Returns the (ys, xs) image pixels of the ring around one point. Close to
+    the top or left edge PIL truncates the negative coordinates of the ring
+    and draws a slightly different shape, so the ring is drawn on its own.
+    """
+    pad = int(math.ceil(radius)) + 1
+    if x >= pad and y >= pad:
+        dy, dx = ring_sprite(radius, width)
+        return y + dy, x + dx
+    if x + pad < 0 or y + pad < 0:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+
+    # Shifting along an axis where the ring stays in positive coordinates
+    # does not change its shape
+    shift_x, shift_y = max(x - pad, 0), max(y - pad, 0)
+    x, y = x - shift_x, y - shift_y
+    canvas = Image.new("L", (x + pad + 1, y + pad + 1), 0)
+    ImageDraw.Draw(canvas).ellipse(
+        [(x - radius, y - radius), (x + radius, y + radius)],
+        outline=255,
+        width=width,
+    )
+    ring_y, ring_x = np.nonzero(np.asarray(canvas))
+    return ring_y + shift_y, ring_x + shift_x
+
+
+def stamp_points(buffer, xs, ys, labels, label_colors, radius, width, offset=(0, 0)):
+    """
+    Stamps the rings of the points on a C-contiguous (height, width, 4) RGBA
+    uint8 buffer. Points are stamped in order, so later points cover earlier
+    ones, and the result is the same as with one `ImageDraw.ellipse` call per
+    point.
+
+    The rings that fit whole in the buffer are written as packed RGBA words:
+    small rings in vectorised scatter batches, large ones slice by slice
+    through their mask. Only the rings cut by the border of the buffer or of
+    the image are drawn on their own.
+
+    Args:
+        buffer (np.ndarray): RGBA pixels, modified in place.
+        xs, ys, labels (np.ndarray): Coordinates and label codes of the points.
+        label_colors (dict): RGB color of each label code.
+        radius (float): Radius of the rings.
+        width (int): Width of the ring outline.
+        offset (tuple): Image coordinates of the buffer origin.
+    """
+    if len(xs) == 0:
+        return
+
+    dy, dx = ring_sprite(radius, width)
+    pad = int(math.ceil(radius)) + 1
+    height, width_px = buffer.shape[:2]
+    pixels = buffer.view(np.uint32).reshape(height * width_px)
+
+    xs = np.asarray(xs, dtype=np.int64)
+    ys = np.asarray(ys, dtype=np.int64)
+    labels = np.asarray(labels, dtype=np.intp)
+    colors = label_palette(label_colors, labels, 4).view(np.uint32).ravel()[labels]
+
+    bx = xs - offset[0]
+    by = ys - offset[1]
+    ring_offsets = dy * width_px + dx
+    cut = (
+        (xs < pad) | (ys < pad)
+        | (bx < pad) | (by < pad) | (bx >= width_px - pad) | (by >= height - pad)
+    )
+
+    if len(dy) <= SCATTER_MAX_PIXELS:
+        stamp_whole = functools.partial(_scatter_rings, ring_offsets=ring_offsets, width_px=width_px)
+    else:
+        stamp_whole = functools.partial(_blit_rings, mask=ring_mask(radius, width), width_px=width_px)
+
+    # Runs of whole rings, split at the rings that are cut
+    start = 0
+    for stop in np.flatnonzero(cut).tolist() + [len(xs)]:
+        if start < stop:
+            stamp_whole(pixels, bx[start:stop], by[start:stop], colors[start:stop])
+
+        if stop < len(xs):
+            ring_y, ring_x = _ring_pixels(int(xs[stop]), int(ys[stop]), radius, width)
+            ring_y = ring_y - offset[1]
+            ring_x = ring_x - offset[0]
+            inside = (ring_y >= 0) & (ring_y < height) & (ring_x >= 0) & (ring_x < width_px)
+            pixels[ring_y[inside] * width_px + ring_x[inside]] = colors[stop]
+        start = stop + 1
+
+
+def render_points(image, store, label_colors, radius, width):
+    """
+    Returns an RGB copy of the image with the rings of all the points of a
+    PointStore, for batch exports.
+    """
+    renderer = OverlayRenderer(image.size, label_colors, radius, width)
+    renderer.redraw(store)
+    return renderer.composite(image.convert("RGB"))
+
+
+class OverlayRenderer:
+    """
+    Transparent RGBA layer with the annotated points of one image, drawn as
+    rings with the color of their label.
+
+    After an edit only the boxes around the changed points are redrawn (both
+    where they were and where they are now), so the cost follows the size of
+    the change, not the size of the image or the number of points. The layer
+    is composited on the image only when the annotated image is exported.
+
+    Args:
+        size (tuple): (width, height) of the image.
+        label_colors (dict): RGB color of each label code.
+        radius (float): Radius of the rings.
+        width (int): Width of the ring outline.
+    """
+
+    def __init__(self, size, label_colors, radius, width):
+        self.size = tuple(size)
+        self.label_colors = label_colors
+        self.radius = radius
+        self.width = width
+        self.version = None
+
+        self._layer = np.zeros((self.size[1], self.size[0], 4), dtype=np.uint8)
+        self._pad = int(math.ceil(radius)) + 1
+        self._points = {}  # Point id -> (x, y, label_id) as drawn
+
+    @property
+    def overlay(self):
+        return Image.fromarray(self._layer)
+
+    def redraw(self, store):
+        """
+        Draws all the points of a PointStore on a clear layer.
+        """
+        ids, xs, ys, labels = store.columns()
+        self._layer[:] = 0
+        stamp_points(self._layer, xs, ys, labels, self.label_colors, self.radius, self.width)
+
+        self._points = dict(zip(ids.tolist(), zip(xs.tolist(), ys.tolist(), labels.tolist())))
+        self.version = store.version
+
+    def _box(self, x, y):
+        pad = self._pad
+        return (
+            max(x - pad, 0), max(y - pad, 0),
+            min(x + pad + 1, self.size[0]), min(y + pad + 1, self.size[1]),
+        )
+
+    def update(self, store, changes):
+        """
+        Redraws the regions touched by a change-set already applied to
+        `store`.
+        """
+        changed = list(changes.removed) \
+            + [point_id for point_id, *_ in changes.moved] \
+            + [point_id for point_id, _ in changes.relabeled]
+
+        if len(changed) + len(changes.added) > MAX_DIRTY_BOXES:
+            self.redraw(store)
+            return
+
+        # Regions where the changed points were drawn, and where they go
+        boxes = [self._box(*self._points[point_id][:2]) for point_id in changed if point_id in self._points]
+        for point_id in changed:
+            self._points.pop(point_id, None)
+
+        _, xs, ys, labels = store.columns()
+        for point_id in set(changed).union(point_id for point_id, *_ in changes.added):
+            if point_id in store:
+                x, y, label = store.get(point_id)
+                self._points[point_id] = (x, y, label)
+                boxes.append(self._box(x, y))
+
+        # Redraw each box from scratch, with every point overlapping it, so
+        # that it ends up as a full redraw would leave it
+        pad = self._pad
+        for x0, y0, x1, y1 in boxes:
+            if x0 >= x1 or y0 >= y1:
+                continue
+            tile = np.zeros((y1 - y0, x1 - x0, 4), dtype=np.uint8)
+            hit = (xs + pad >= x0) & (xs - pad < x1) & (ys + pad >= y0) & (ys - pad < y1)
+            stamp_points(tile, xs[hit], ys[hit], labels[hit], self.label_colors, self.radius, self.width, offset=(x0, y0))
+            self._layer[y0:y1, x0:x1] = tile
+
+        self.version = store.version
+
+    def composite(self, image):
+        """
+        Returns the image with the layer of points on top of it.
+        """
+        result = Image.alpha_composite(image.convert("RGBA"), self.overlay)
+        return result if image.mode == "RGBA" else result.convert("RGB")
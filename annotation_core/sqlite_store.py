@@ -0,0 +1,287 @@
+import csv
+import datetime
+import os
+import sqlite3
+import threading
+from pathlib import Path
+
+import numpy as np
+
+from .image_store import shard_path
+from .journal import AnnotationJournal
+from .point_store import PointStore
+
+# Database shared by every annotator
+DEFAULT_DB_PATH = Path(__file__).parent.parent.absolute() / "data" / "annotations.sqlite3"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS images (
+    id INTEGER PRIMARY KEY,
+    annotator TEXT NOT NULL,
+    name TEXT NOT NULL,
+    updated_at TEXT NOT NULL,
+    next_point_id INTEGER NOT NULL DEFAULT 1,
+    UNIQUE (annotator, name)
+);
+CREATE TABLE IF NOT EXISTS points (
+    image_id INTEGER NOT NULL REFERENCES images(id) ON DELETE CASCADE,
+    point_id INTEGER NOT NULL,
+    x INTEGER NOT NULL,
+    y INTEGER NOT NULL,
+    label TEXT NOT NULL,
+    PRIMARY KEY (image_id, point_id)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS points_by_label ON points (image_id, label);
+CREATE TABLE IF NOT EXISTS reports (
+    image_id INTEGER PRIMARY KEY REFERENCES images(id) ON DELETE CASCADE,
+    content TEXT NOT NULL,
+    created_at TEXT NOT NULL
+);
+"""
+
+
+def _now():
+    return datetime.datetime.now(datetime.timezone.utc).isoformat(timespec="seconds")
+
+
+class AnnotationDatabase:
+    """
+    SQLite storage of the points and reports of every annotator.
+
+    The database runs in WAL mode, so sessions read while another one writes,
+    and every save is a single transaction. Each thread gets its own
+    connection (Streamlit runs every session in its own thread).
+
+    Args:
+        path (str, optional): Path of the database file.
+    """
+
+    def __init__(self, path=DEFAULT_DB_PATH):
+        self.path = str(path)
+        self._local = threading.local()
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        with self._connect() as conn:
+            conn.executescript(SCHEMA)
+
+    def _connect(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("PRAGMA foreign_keys=ON")
+            self._local.conn = conn
+        return conn
+
+    def _image_id(self, conn, annotator, name, create=False):
+        row = conn.execute("SELECT id FROM images WHERE annotator = ? AND name = ?", (annotator, name)).fetchone()
+        if row is not None:
+            if create:
+                conn.execute("UPDATE images SET updated_at = ? WHERE id = ?", (_now(), row[0]))
+            return row[0]
+        if not create:
+            return None
+        cursor = conn.execute("INSERT INTO images (annotator, name, updated_at) VALUES (?, ?, ?)", (annotator, name, _now()))
+        return cursor.lastrowid
+
+    def load_points(self, annotator, name, label_list):
+        """
+        Returns the points of an image as a PointStore (empty if the image is
+        not in the database).
+        """
+        store = PointStore(label_list)
+        conn = self._connect()
+        image_id = self._image_id(conn, annotator, name)
+        if image_id is None:
+            return store
+
+        rows = conn.execute("SELECT point_id, x, y, label FROM points WHERE image_id = ? ORDER BY point_id", (image_id,))
+        for point_id, x, y, label in rows:
+            store.add(x, y, label_list.index(label), point_id)
+        return store
+
+    def save_points(self, annotator, name, store):
+        """
+        Replaces all the points of an image by the contents of `store`.
+        """
+        ids, xs, ys, labels = store.columns()
+        names = np.array(store.label_list, dtype=object)[labels]
+        with self._connect() as conn:
+            image_id = self._image_id(conn, annotator, name, create=True)
+            conn.execute("DELETE FROM points WHERE image_id = ?", (image_id,))
+            conn.executemany(
+                "INSERT INTO points (image_id, point_id, x, y, label) VALUES (?, ?, ?, ?, ?)",
+                zip([image_id] * len(ids), ids.tolist(), xs.tolist(), ys.tolist(), names.tolist()),
+            )
+
+    def apply_changes(self, annotator, name, changes, label_list):
+        """
+        Applies a change-set to the points of an image, in one transaction.
+        """
+        if not changes:
+            return
+        with self._connect() as conn:
+            image_id = self._image_id(conn, annotator, name, create=True)
+            conn.executemany(
+                "DELETE FROM points WHERE image_id = ? AND point_id = ?",
+                [(image_id, point_id) for point_id in changes.removed],
+            )
+            conn.executemany(
+                "INSERT OR REPLACE INTO points (image_id, point_id, x, y, label) VALUES (?, ?, ?, ?, ?)",
+                [(image_id, point_id, x, y, label_list[label_id]) for point_id, x, y, label_id in changes.added],
+            )
+            conn.executemany(
+                "UPDATE points SET x = ?, y = ? WHERE image_id = ? AND point_id = ?",
+                [(x, y, image_id, point_id) for point_id, x, y in changes.moved],
+            )
+            conn.executemany(
+                "UPDATE points SET label = ? WHERE image_id = ? AND point_id = ?",
+                [(label_list[label_id], image_id, point_id) for point_id, label_id in changes.relabeled],
+            )
+
+    def reserve_point_ids(self, annotator, name, count):
+        """
+        Reserves `count` consecutive point ids for an image and returns the
+        first one. The ids are issued by the database, above every stored
+        point and every id reserved before, so sessions adding points to
+        the same image never share an id.
+        """
+        with self._connect() as conn:
+            # Creating or touching the image row takes the write lock, so
+            # concurrent reservations are serialized
+            image_id = self._image_id(conn, annotator, name, create=True)
+            first = conn.execute(
+                "SELECT MAX(next_point_id, (SELECT COALESCE(MAX(point_id), 0) + 1 FROM points WHERE image_id = ?)) "
+                "FROM images WHERE id = ?",
+                (image_id, image_id),
+            ).fetchone()[0]
+            conn.execute("UPDATE images SET next_point_id = ? WHERE id = ?", (first + count, image_id))
+        return first
+
+    def save_report(self, annotator, name, content):
+        with self._connect() as conn:
+            image_id = self._image_id(conn, annotator, name, create=True)
+            conn.execute(
+                "INSERT OR REPLACE INTO reports (image_id, content, created_at) VALUES (?, ?, ?)",
+                (image_id, content, _now()),
+            )
+
+    def load_report(self, annotator, name):
+        row = self._connect().execute(
+            "SELECT content FROM reports JOIN images ON images.id = reports.image_id "
+            "WHERE images.annotator = ? AND images.name = ?",
+            (annotator, name),
+        ).fetchone()
+        return None if row is None else row[0]
+
+    def has_image(self, annotator, name):
+        return self._image_id(self._connect(), annotator, name) is not None
+
+    def rename_image(self, annotator, name, new_name):
+        """
+        Renames an image with its points and report, unless `new_name` is
+        taken already.
+        """
+        with self._connect() as conn:
+            conn.execute(
+                "UPDATE OR IGNORE images SET name = ? WHERE annotator = ? AND name = ?",
+                (new_name, annotator, name),
+            )
+
+    def annotated_images(self, annotator=None):
+        """
+        Returns (annotator, name, number of points) for every image with at
+        least one point, most recently updated first.
+        """
+        query = (
+            "SELECT images.annotator, images.name, COUNT(*) FROM images "
+            "JOIN points ON points.image_id = images.id "
+            + ("WHERE images.annotator = ? " if annotator is not None else "")
+            + "GROUP BY images.id ORDER BY images.updated_at DESC"
+        )
+        params = (annotator,) if annotator is not None else ()
+        return self._connect().execute(query, params).fetchall()
+
+    def label_counts(self, annotator):
+        """
+        Returns the number of points of each label across all the images of
+        an annotator.
+        """
+        rows = self._connect().execute(
+            "SELECT points.label, COUNT(*) FROM points JOIN images ON images.id = points.image_id "
+            "WHERE images.annotator = ? GROUP BY points.label",
+            (annotator,),
+        )
+        return dict(rows.fetchall())
+
+    def import_csv_tree(self, annotator, ann_dir, report_dir=None):
+        """
+        Imports the `X,Y,Label[,Id]` CSV snapshots of `ann_dir`, with the
+        edits journaled since them, and the TXT reports of `report_dir` as the
+        images of `annotator`. Returns the number of images imported.
+        """
+        imported = 0
+        # Files are either at the top of the folders or in the subfolders
+        # of `shard_path`
+        for csv_path in sorted(Path(ann_dir).rglob("*.csv")):
+            name = csv_path.stem
+            with open(csv_path, "r", encoding="utf-8", newline="") as csv_file:
+                rows = list(csv.DictReader(csv_file))
+
+            # The label codes are only used to load the store here
+            journal = AnnotationJournal(csv_path, [])
+            label_list = _label_names(rows, [journal.old_path, journal.path])
+            journal.label_list = label_list
+
+            store = PointStore(label_list)
+            for row in rows:
+                point_id = int(row["Id"]) if row.get("Id") else None
+                store.add(int(row["X"]), int(row["Y"]), label_list.index(row["Label"]), point_id)
+            journal.replay(store)
+            self.save_points(annotator, name, store)
+
+            if report_dir is not None:
+                report_path = Path(report_dir) / f"{name}.txt"
+                if not report_path.exists():
+                    report_path = Path(shard_path(report_dir, name, ".txt"))
+                if report_path.exists():
+                    self.save_report(annotator, name, report_path.read_text(encoding="utf-8"))
+            imported += 1
+        return imported
+
+
+def _label_names(rows, journal_paths):
+    """
+    Returns the label names used by CSV rows and journal records, in order of
+    appearance.
+    """
+    names = dict.fromkeys(row["Label"] for row in rows)
+    for path in journal_paths:
+        try:
+            with open(path, "r", encoding="utf-8", newline="") as journal_file:
+                for record in csv.reader(journal_file):
+                    if record[:1] == ["a"] and len(record) > 4:
+                        names.setdefault(record[4])
+                    elif record[:1] == ["r"] and len(record) > 2:
+                        names.setdefault(record[2])
+        except FileNotFoundError:
+            pass
+    return list(names)
+
+_databases = {}
+_databases_lock = threading.Lock()
+
+
+def open_database(path=None):
+    """
+    Returns the process-wide database at `path` (by default the one set by
+    the ANNOTATION_DB environment variable, or DEFAULT_DB_PATH).
+    """
+    if path is None:
+        path = os.environ.get("ANNOTATION_DB", DEFAULT_DB_PATH)
+    key = os.path.abspath(path)
+    with _databases_lock:
+        if key not in _databases:
+            _databases[key] = AnnotationDatabase(path)
+        return _databases[key]
+
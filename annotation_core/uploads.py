@@ -0,0 +1,67 @@
+import hashlib
+import os
+import tempfile
+
+# Bytes written and hashed at a time
+CHUNK_SIZE = 1 << 20
+
+
+def copy_upload(uploaded_file, folder, chunk_size=CHUNK_SIZE):
+    """
+    Copies an uploaded file, as it was sent, into a temporary file of
+    `folder`, and computes its SHA-256 in the same pass.
+
+    The bytes are copied in chunks straight from the buffer of the upload.
+    The caller renames the temporary file into place, or removes it.
+
+    Args:
+        uploaded_file: Streamlit UploadedFile, or any file object.
+        folder (str): Folder of the temporary file.
+        chunk_size (int, optional): Bytes copied at a time.
+
+    Returns:
+        tuple: Path of the temporary file, and SHA-256 of the file, hex
+            encoded.
+    """
+    os.makedirs(folder, exist_ok=True)
+
+    # UploadedFile is a BytesIO, whose buffer is read without copying it
+    if hasattr(uploaded_file, "getbuffer"):
+        buffer = uploaded_file.getbuffer()
+        chunks = (buffer[start:start + chunk_size] for start in range(0, len(buffer), chunk_size))
+    else:
+        uploaded_file.seek(0)
+        chunks = iter(lambda: uploaded_file.read(chunk_size), b"")
+
+    sha256 = hashlib.sha256()
+    fd, tmp_path = tempfile.mkstemp(dir=folder, prefix=".upload-", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as file:
+            for chunk in chunks:
+                sha256.update(chunk)
+                file.write(chunk)
+            file.flush()
+            os.fsync(file.fileno())
+    except BaseException:
+        _discard(tmp_path)
+        raise
+
+    return tmp_path, sha256.hexdigest()
+
+
+def file_sha256(path, chunk_size=CHUNK_SIZE):
+    """
+    SHA-256 of a stored file, hex encoded, read in chunks.
+    """
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as file:
+        for chunk in iter(lambda: file.read(chunk_size), b""):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def _discard(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
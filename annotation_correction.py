@@ -1,7 +1,6 @@
 
 import numpy as np
 from PIL import Image, ImageDraw
-import cv2
 
 from image_annotation import *
 
@@ -29,20 +28,29 @@ def overlay_masks_on_image(pil_image, masks, mask_colors=[], transparency=0.5, t
 
     # Convert PIL image to RGBA if not already in that mode
     img = pil_image.convert("RGBA")
-    overlay = Image.new("RGBA", img.size, (255, 255, 255, 0))
-
-    for mask, fill_color in zip(masks, mask_colors):
-        fill_color = [int(c) for c in fill_color]
-        rgba_fill = (*fill_color, int(255 * transparency))
-        # Create a mask image from the segmentation
-        mask = Image.fromarray((mask * 255).astype(np.uint8), mode="L")
-        overlay.paste(Image.new("RGBA", img.size, rgba_fill), mask=mask)
-
-        if borders:
-            # Draw borders
-            contours, _ = cv2.findContours(mask.astype(np.uint8), cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_NONE)
+
+    # Index (+ 1) of the last mask covering each pixel, as pasting the masks
+    # one after another would leave it
+    owner = np.zeros((img.size[1], img.size[0]), dtype=np.int32)
+    for index, mask in enumerate(masks, start=1):
+        owner[np.asarray(mask) > 0] = index
+
+    # Fill all the masks in a single pass
+    palette = np.zeros((len(masks) + 1, 4), dtype=np.uint8)
+    palette[0] = (255, 255, 255, 0)
+    palette[1:, :3] = np.asarray(mask_colors, dtype=np.int64)[:len(masks)]
+    palette[1:, 3] = int(255 * transparency)
+    overlay = Image.fromarray(palette[owner])
+
+    if borders:
+        # OpenCV is only needed to trace the borders, so it is imported here
+        import cv2
+
+        # Draw borders
+        draw = ImageDraw.Draw(overlay)
+        for mask in masks:
+            contours, _ = cv2.findContours((np.asarray(mask) > 0).astype(np.uint8), cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_NONE)
             contours = [cv2.approxPolyDP(contour, epsilon=0.01, closed=True) for contour in contours]
-            draw = ImageDraw.Draw(overlay)
             for contour in contours:
                 points = [tuple(pt[0]) for pt in contour]
                 draw.line(points + [points[0]], fill=(0, 0, 255, int(255 * 0.4)), width=thickness)
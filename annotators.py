@@ -0,0 +1,84 @@
+from dataclasses import dataclass
+
+
+@dataclass(frozen=True)
+class Annotator:
+    """
+    Annotator offered in the application selector of main.py.
+
+    Attributes:
+        name (str): Name shown in the selector.
+        module (str): Module with its `image_ann`, imported the first time
+            the annotator is selected.
+        key (str): Key of its session state, also used as the annotator
+            name in the shared database.
+        label_list (list): Classes of the points.
+        label_colors (dict): RGB color of each class, by class index.
+        enabled (bool): Whether the annotator can be opened yet.
+    """
+    name: str
+    module: str
+    key: str
+    label_list: list
+    label_colors: dict
+    enabled: bool = True
+
+
+# Classes shared by the nuclear staining annotators
+NUCLEAR_LABELS = ['Positivo', 'Negativo', 'No importante']
+NUCLEAR_COLORS = {
+    0: (255, 0, 0),  # Red
+    1: (0, 255, 0),  # Green
+    2: (0, 0, 255),  # Blue
+    # Add more labels and their colors as needed
+}
+
+ANNOTATORS = [
+    Annotator(
+        name="Anotador HER2",
+        module="her2_annotator.her2_annotation",
+        key="her2",
+        label_list=['Completa 3+', 'Completa 2+', 'Completa 1+', 'Incompleta 2+', 'Incompleta 1+', 'Ausente'],
+        label_colors={
+            0: (255, 0, 0),       # Red
+            1: (255, 165, 0),     # Orange
+            2: (255, 255, 0),     # Yellow
+            3: (0, 128, 0),       # Green
+            4: (0, 0, 255),       # Blue
+            5: (128, 128, 128)    # Gray
+        },
+    ),
+    Annotator(
+        name="Anotador KI67",
+        module="ki67_annotator.ki67_annotation",
+        key="ki67",
+        label_list=NUCLEAR_LABELS,
+        label_colors=NUCLEAR_COLORS,
+    ),
+    Annotator(
+        name="Anotador Estrógeno",
+        module="estr_annotator.estr_annotation",
+        key="estrogeno",
+        label_list=NUCLEAR_LABELS,
+        label_colors=NUCLEAR_COLORS,
+        enabled=False,
+    ),
+    Annotator(
+        name="Anotador Progesterona",
+        module="prog_annotator.prog_annotation",
+        key="progesterona",
+        label_list=NUCLEAR_LABELS,
+        label_colors=NUCLEAR_COLORS,
+        enabled=False,
+    ),
+]
+
+
+def get_annotator(key):
+    """
+    Returns the registered annotator with the given session state key.
+    """
+    for annotator in ANNOTATORS:
+        if annotator.key == key:
+            return annotator
+    raise KeyError(key)
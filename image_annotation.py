@@ -1,7 +1,7 @@
 import streamlit as st
 from streamlit_image_annotation import pointdet
+from annotation_core import PointStore, diff_points, apply_changes, apply_ops, open_journal
 import io
-import csv
 from PIL import Image
 from PIL import Image, ImageDraw
 import numpy as np
@@ -19,48 +19,30 @@ actions = ['Agregar', 'Borrar']
 
 def init_session(session_state):
 
-    session_state['all_points'] = set()  # Set to track unique point
-    session_state['all_labels'] = {}  # Dictionary to track labels for each unique point
-    session_state['points'] = []
-    session_state['labels'] = []
+    session_state['store'] = PointStore(label_list)  # Columnar storage of the annotated points
     session_state['csv_data'] = b""
     session_state['report_data'] = b""
     session_state['ann_image'] = b"" 
 
 
-def update_patch_data(session_state, all_points, all_labels):
+def update_results(session_state, store, file_name, changes=None):
 
-    points = list(all_points)
-    labels = [all_labels[point] for point in all_points]
+    # Nothing to persist if the last patch did not change any point
+    if changes is not None and not changes:
+        return
 
-    session_state['points'] = points
-    session_state['labels'] = labels
+    # Create CSV content (for download)
+    csv_data = store.to_csv_bytes()
 
-
-def update_results(session_state, all_points, all_labels, file_name):
-
-    points = list(all_points)
-    labels = [all_labels[point] for point in all_points]
-
-    # Create CSV content
-    csv_buffer = io.StringIO()
-    csv_writer = csv.writer(csv_buffer)
-    csv_writer.writerow(["X", "Y", "Label"])
-    for point, label in zip(points, labels):
-        csv_writer.writerow([point[0], point[1], label_list[label]])
-
-    # Convert CSV buffer to downloadable file
-    csv_data = csv_buffer.getvalue().encode('utf-8')
-
-    # Save CSV data to file
-    csv_data = csv_buffer.getvalue()
-    csv_filename = f"{ann_dir}/{file_name}.csv"
-    with open(csv_filename, "w", encoding="utf-8") as csv_file:
-        csv_file.write(csv_data)
+    # Journal the edits; a recovered session was just loaded from them
+    if changes is not None:
+        csv_filename = f"{ann_dir}/{file_name}.csv"
+        open_journal(csv_filename, label_list).append(changes)
 
     # **Generate the Annotation Report**
-    num_positive = labels.count(0)
-    num_negative = labels.count(1)
+    counts = store.counts_by_label()
+    num_positive = int(counts[0])
+    num_negative = int(counts[1])
 
     total = num_positive + num_negative
 
@@ -90,67 +72,41 @@ def update_results(session_state, all_points, all_labels, file_name):
     session_state['report_data'] = report_data
 
 
-def update_annotations(new_labels, all_points, all_labels, session_state):
-
-    patch_points = []
-
-    # Add new points
-    for v in new_labels:
-        x, y = v['point']
-
-        x = int(x)
-        y = int(y)
-
-        label_id = v['label_id']
-        patch_points.append([x, y])
-
-        point_tuple = (x, y)
-
-        if point_tuple not in all_points:
-            all_points.add(point_tuple)
-            all_labels[point_tuple] = label_id  # Store the label for this point
-
-    # Remove points
-    removed_points = []
-    for global_point in all_points:
-        x, y = global_point
-
-        remove_flag = True
-
-        for patch_point in patch_points:
-
-            x_patch, y_patch = patch_point
-
-            nequal_flag = not ( (x == x_patch) and (y == y_patch) )
-
-            remove_flag = remove_flag and nequal_flag
-
-        if remove_flag:
-            removed_points.append(global_point)
-
+def update_annotations(new_labels, store):
+    """
+    Incorporates the ops returned by `pointdet` into the stored points.
 
-    for removed_point in removed_points:
-        all_points.remove(removed_point)
-        del all_labels[removed_point]  # Remove the corresponding label
+    Returns:
+        ChangeSet: The added, removed, moved and relabeled points, so callers
+            can skip persisting and rendering when nothing changed.
+    """
 
-    session_state['all_points'] = all_points
-    session_state['all_labels'] = all_labels
+    # Older frontend builds send their full point list instead of ops,
+    # which is diffed against the stored points
+    if not new_labels or 'op' not in new_labels[0]:
+        changes = diff_points(new_labels, store)
+        apply_changes(changes, store)
+        return changes
 
-    return all_points, all_labels
+    return apply_ops(new_labels, store)
 
 
-def update_ann_image(session_state, all_points, all_labels, image):
+def update_ann_image(session_state, store, image, changes=None):
     """
     Overlays points on the image with colors corresponding to their labels 
     and stores the result in the session state for display and download.
 
     Args:
-        session_state: dict containing `all_points` and `all_labels`.
-            - `all_points`: List of tuples representing points (x, y).
-            - `all_labels`: Dictionary mapping points to labels.
+        session_state: dict where the annotated image is stored.
+        store: PointStore with the annotated points.
         image: PIL.Image object representing the base image.
+        changes: ChangeSet of the last patch. When empty, the previous
+            annotated image is kept.
     """
 
+    if changes is not None and not changes:
+        return
+
     # Define colors for each label
     label_colors = {
         0: (255, 0, 0),  # Red
@@ -165,9 +121,8 @@ def update_ann_image(session_state, all_points, all_labels, image):
 
     # Draw each point with the corresponding color
     point_radius = 7.5  # Radius of each point
-    for point in all_points:
-        x, y = point
-        label = all_labels.get(point, "default")  # Get the label for the point
+    _, xs, ys, labels = store.columns()
+    for x, y, label in zip(xs.tolist(), ys.tolist(), labels.tolist()):
         color = label_colors.get(label, (255, 255, 255))  # Default to white if label not found
 
         # Draw the point as a filled circle
@@ -186,14 +141,12 @@ def update_ann_image(session_state, all_points, all_labels, image):
     session_state['ann_image'] = image_buffer
 
 
-def recover_session(session_state, all_points, all_labels, image, file_name):
+def recover_session(session_state, store, image, file_name):
 
-    session_state['all_points'] = all_points 
-    session_state['all_labels'] = all_labels 
+    session_state['store'] = store
 
-    update_patch_data(session_state, all_points, all_labels)
-    update_results(session_state, all_points, all_labels, file_name)
-    update_ann_image(session_state, all_points, all_labels, image)
+    update_results(session_state, store, file_name)
+    update_ann_image(session_state, store, image)
 
 
 def check_latest_session_log(log_path = "latest_session.log"):
@@ -245,38 +198,24 @@ def check_files(image_file_name, folder_path="./images"):
 def read_results_from_csv(csv_filename):
     """
     Reads the contents of a CSV file created by the `update_results` function
-    and extracts all_points and all_labels.
+    into a PointStore, and replays the edits journaled since it was written.
 
     Args:
         csv_filename (str): Path to the CSV file to read.
 
     Returns:
-        tuple: A tuple containing:
-            - all_points (list of tuples): List of points [(x1, y1), (x2, y2), ...].
-            - all_labels (list): List of labels corresponding to each point.
+        PointStore: The stored points and their labels.
     """
-    all_points = set()
-    all_labels = {}
+    store = PointStore(label_list)
 
     try:
-        with open(csv_filename, mode="r", encoding="utf-8") as csv_file:
-            csv_reader = csv.DictReader(csv_file)  # Read CSV with headers
-            for row in csv_reader:
-                # Extract X, Y, and Label, and reconstruct all_points and all_labels
-                x = int(row["X"])
-                y = int(row["Y"])
-                label_id = label_list.index(row["Label"])
-                point_tuple = (x, y)
-
-                all_points.add(point_tuple)
-                all_labels[point_tuple] = label_id  # Store the label for this point
-
-    except FileNotFoundError:
-        print(f"Error: File '{csv_filename}' not found.")
+        # The snapshot and the edits journaled since it was written are read
+        # together, so a compaction running meanwhile cannot drop any of them
+        open_journal(csv_filename, label_list).load(store)
     except Exception as e:
         print(f"Error reading the file: {e}")
     
-    return all_points, all_labels
+    return store
 
 
 def get_image():
@@ -319,8 +258,8 @@ def handle_new_image(session_state, image, image_file_name, img_path):
     if result: # Recover previous annotations
         base_name = os.path.splitext(image_file_name)[0]
         csv_file_name = f"{ann_dir}/{base_name}.csv"
-        all_points, all_labels = read_results_from_csv(csv_file_name)
-        recover_session(session_state, all_points, all_labels, image, base_name)
+        store = read_results_from_csv(csv_file_name)
+        recover_session(session_state, store, image, base_name)
 
     else: # We store a backup of the image
         image.save(img_path)
@@ -362,8 +301,7 @@ def image_ann(session_state):
             handle_new_image(session_state, image, image_file_name, img_path)
 
         try:
-            all_points = session_state['all_points']
-            all_labels = session_state['all_labels']
+            store = session_state['store']
 
             # Translate the selected action
             action = session_state['action']
@@ -377,20 +315,17 @@ def image_ann(session_state):
         except KeyError:
             base_name = os.path.splitext(image_file_name)[0]
             csv_file_name = f"{ann_dir}/{base_name}.csv"
-            all_points, all_labels = read_results_from_csv(csv_file_name)
-            recover_session(session_state, all_points, all_labels, image, base_name)
+            store = read_results_from_csv(csv_file_name)
+            recover_session(session_state, store, image, base_name)
 
             mode  = 'Transform'
 
-
-        update_patch_data(session_state, all_points, all_labels)
                     
         # Use pointdet to annotate the image
         new_labels = pointdet(
             image_path=img_path,
             label_list=label_list,
-            points=session_state['points'],
-            labels=session_state['labels'],
+            point_store=store,
             width = image.size[0],
             height = image.size[1],
             use_space=True,
@@ -399,18 +334,21 @@ def image_ann(session_state):
             label = session_state['label'],
             point_width=5,
             zoom=zoom,
+            sync_interval_ms=1000,
+            sync_every_n_ops=10,
+            id_allocator=open_journal(f"{ann_dir}/{os.path.splitext(image_file_name)[0]}.csv", label_list).reserve_ids,
         )
         
         # Update points and labels in session state if any changes are made
         if new_labels is not None:
 
             # Incorporate the new labels
-            all_points, all_labels = update_annotations(new_labels, all_points, all_labels, session_state)
+            changes = update_annotations(new_labels, store)
 
             # Update results
             base_name = os.path.splitext(image_file_name)[0]
-            update_results(session_state, all_points, all_labels, base_name)
-            update_ann_image(session_state, all_points, all_labels, image)
+            update_results(session_state, store, base_name, changes)
+            update_ann_image(session_state, store, image, changes)
 
 
 
@@ -1,11 +1,9 @@
 import streamlit as st
 from streamlit_image_annotation import pointdet
+from annotators import get_annotator
+from annotation_core import PointStore, diff_points, apply_changes, apply_ops, open_journal, open_database, get_persistence_service, OverlayRenderer, ImageStore, shard_path
 import io
-import csv
 from PIL import Image
-from PIL import Image, ImageDraw
-import numpy as np
-import pandas as pd
 import os
 from pathlib import Path
 
@@ -15,63 +13,92 @@ DATA_DIR = MODULE_DIR / "data"
 IMAGE_DIR = DATA_DIR / "images"
 ANN_DIR = DATA_DIR / "annotations"
 REPORT_DIR = DATA_DIR / "reports"
+TILE_DIR = DATA_DIR / "tiles"
 LOG_FILE = DATA_DIR / "latest_session.log"
+MANIFEST_FILE = DATA_DIR / "manifest.json"
 
-# Create all directories
-DATA_DIR.mkdir(parents=True, exist_ok=True)
-IMAGE_DIR.mkdir(parents=True, exist_ok=True)
-ANN_DIR.mkdir(parents=True, exist_ok=True)
-REPORT_DIR.mkdir(parents=True, exist_ok=True)
+# Storage backend: "csv" (CSV/TXT files per image) or "sqlite" (database shared by all the annotators)
+STORAGE_BACKEND = os.environ.get("ANNOTATION_BACKEND", "csv")
+ANNOTATOR_NAME = "progesterona"
 
-# Define label list
-label_list = ['Positivo', 'Negativo', 'No importante']
+# Labels and colors, from the registry of annotators
+annotator = get_annotator(ANNOTATOR_NAME)
+label_list = annotator.label_list
+label_colors = annotator.label_colors
 actions = ['Agregar', 'Borrar']
 
+# Images, stored by the hash of their contents, which also keys their annotations
+image_store = ImageStore(IMAGE_DIR, MANIFEST_FILE)
+
+def create_dirs():
+    """
+    Creates the data folders of the annotator. Called when it is opened, not
+    on import, so unused annotators leave no folders behind.
+    """
+    for folder in (DATA_DIR, IMAGE_DIR, ANN_DIR, REPORT_DIR):
+        folder.mkdir(parents=True, exist_ok=True)
+
+
 def init_session(session_state):
     session_state.update({
-        'all_points': set(),
-        'all_labels': {},
-        'points': [],
-        'labels': [],
-        'csv_data': b"",  # Inicializar como bytes vacíos
-        'report_data': b"",
-        'ann_image': b""
+        'store': PointStore(label_list),
+        'renderer': None,  # Layer of points drawn over the image
+        'export': None,  # Downloads, generated on demand
+        'results_version': None,  # Version of the points the results panel shows
+        'results_stale': False  # Whether the points changed since
     })
 
-def update_patch_data(session_state, all_points, all_labels):
+def update_results(session_state, store, image_key, changes):
 
-    points = list(all_points)
-    labels = [all_labels[point] for point in all_points]
+    # Nothing to persist if the last patch did not change any point
+    if not changes:
+        return
 
-    session_state['points'] = points
-    session_state['labels'] = labels
+    if STORAGE_BACKEND == "sqlite":
+        # Apply the edits in one transaction
+        open_database().apply_changes(ANNOTATOR_NAME, image_key, changes, label_list)
+    else:
+        # Journal the edits
+        csv_filename = shard_path(ANN_DIR, image_key, ".csv")
+        Path(csv_filename).parent.mkdir(parents=True, exist_ok=True)
+        open_journal(csv_filename, label_list).append(changes)
 
+    # The report is saved in the background, from a snapshot of the points.
+    # The jobs are keyed by image, so sessions on the same image share them
+    get_persistence_service().submit(
+        (ANNOTATOR_NAME, image_key, "report"), save_report, store.copy(), image_key
+    )
 
-def update_results(session_state, all_points, all_labels, file_name):
 
-    points = list(all_points)
-    labels = [all_labels[point] for point in all_points]
+def reserve_point_ids(image_key, count):
+    """
+    Reserves `count` consecutive ids for the points added on the canvas and
+    returns the first one, so sessions annotating the same image never add
+    points with the same id.
+    """
+    if STORAGE_BACKEND == "sqlite":
+        return open_database().reserve_point_ids(ANNOTATOR_NAME, image_key, count)
 
-    # Create CSV content
-    csv_buffer = io.StringIO()
-    csv_writer = csv.writer(csv_buffer)
-    csv_writer.writerow(["X", "Y", "Label"])
-    for point, label in zip(points, labels):
-        csv_writer.writerow([point[0], point[1], label_list[label]])
+    csv_filename = shard_path(ANN_DIR, image_key, ".csv")
+    return open_journal(csv_filename, label_list).reserve_ids(count)
 
-    # Convert CSV buffer to downloadable file
-    csv_data = csv_buffer.getvalue().encode('utf-8')
 
-    # Save CSV data to file
-    csv_data = csv_buffer.getvalue()
-    csv_filename = f"{ANN_DIR}/{file_name}.csv"
-    Path(ANN_DIR).mkdir(parents=True, exist_ok=True)
-    with open(csv_filename, "w", encoding="utf-8") as csv_file:
-        csv_file.write(csv_data)
+def build_report(store, file_name):
+    """
+    Generates the annotation report of the points.
+
+    Args:
+        store: PointStore with the annotated points.
+        file_name (str): Name of the image, without extension.
+
+    Returns:
+        str: The report content.
+    """
 
     # **Generate the Annotation Report**
-    num_positive = labels.count(0)
-    num_negative = labels.count(1)
+    counts = store.counts_by_label()
+    num_positive = int(counts[0])
+    num_negative = int(counts[1])
 
     total = num_positive + num_negative
 
@@ -87,125 +114,137 @@ def update_results(session_state, all_points, all_labels, file_name):
     Cantidad total de elementos {total}
     """
 
-    # Create file-like object to download the report
-    report_buffer = io.StringIO()
-    report_buffer.write(report_content)
-    report_data = report_buffer.getvalue()
+    return report_content
 
-    # Save report to file
-    report_filename = f"{REPORT_DIR}/{file_name}.txt"
-    Path(REPORT_DIR).mkdir(parents=True, exist_ok=True)
-    with open(report_filename, "w", encoding="utf-8") as report_file:
-        report_file.write(report_content)
 
-    session_state['csv_data'] = csv_data
-    session_state['report_data'] = report_data
+def save_report(store, image_key):
+    """
+    Saves the report of a snapshot of the points. Runs in the persistence
+    service.
+    """
+    file_name = os.path.splitext(image_store.name(image_key) or image_key)[0]
+    report_content = build_report(store, file_name)
 
+    if STORAGE_BACKEND == "sqlite":
+        open_database().save_report(ANNOTATOR_NAME, image_key, report_content)
+    else:
+        report_filename = shard_path(REPORT_DIR, image_key, ".txt")
+        Path(report_filename).parent.mkdir(parents=True, exist_ok=True)
+        with open(report_filename, "w", encoding="utf-8") as report_file:
+            report_file.write(report_content)
 
-def update_annotations(new_labels, all_points, all_labels, session_state):
 
-    patch_points = []
+def update_annotations(new_labels, store):
+    """
+    Incorporates the ops returned by `pointdet` into the stored points.
 
-    # Add new points
-    for v in new_labels:
-        x, y = v['point']
+    Returns:
+        ChangeSet: The added, removed, moved and relabeled points, so callers
+            can skip persisting and rendering when nothing changed.
+    """
 
-        x = int(x)
-        y = int(y)
+    # Older frontend builds send their full point list instead of ops,
+    # which is diffed against the stored points
+    if not new_labels or 'op' not in new_labels[0]:
+        changes = diff_points(new_labels, store)
+        apply_changes(changes, store)
+        return changes
 
-        label_id = v['label_id']
-        patch_points.append([x, y])
+    return apply_ops(new_labels, store)
 
-        point_tuple = (x, y)
 
-        if point_tuple not in all_points:
-            all_points.add(point_tuple)
-            all_labels[point_tuple] = label_id  # Store the label for this point
+def update_ann_image(session_state, store, image, changes):
+    """
+    Updates the layer of points drawn over the image, with colors
+    corresponding to their labels, if it was created already. Only the
+    regions touched by the last patch are redrawn. The layer is created by
+    `build_ann_image`, so annotating alone never allocates it.
 
-    # Remove points
-    removed_points = []
-    for global_point in all_points:
-        x, y = global_point
+    Args:
+        session_state: dict where the layer is stored.
+        store: PointStore with the annotated points.
+        image: PIL.Image object representing the base image.
+        changes: ChangeSet of the last patch.
+    """
 
-        remove_flag = True
+    renderer = session_state.get('renderer')
+    if renderer is None or not changes:
+        return
 
-        for patch_point in patch_points:
+    if renderer.size != image.size:
+        # Layer of another image: created again on the next export
+        session_state['renderer'] = None
+    else:
+        renderer.update(store, changes)
 
-            x_patch, y_patch = patch_point
 
-            nequal_flag = not ( (x == x_patch) and (y == y_patch) )
+def build_ann_image(session_state, store, image):
+    """
+    Composites the layer of points on the image.
 
-            remove_flag = remove_flag and nequal_flag
+    Args:
+        session_state: dict where the layer is stored.
+        store: PointStore with the annotated points.
+        image: PIL.Image object representing the base image.
 
-        if remove_flag:
-            removed_points.append(global_point)
+    Returns:
+        bytes: The annotated image, PNG encoded.
+    """
 
+    # The layer is created on the first export, and drawn again if it missed an edit
+    renderer = session_state.get('renderer')
+    if renderer is None or renderer.size != image.size:
+        point_radius = min(image.size) * 0.01  # 1% of the smaller dimension of the image
+        renderer = OverlayRenderer(image.size, label_colors, point_radius, int(point_radius * 3 / 5))
+        session_state['renderer'] = renderer
+    if renderer.version != store.version:
+        renderer.redraw(store)
 
-    for removed_point in removed_points:
-        all_points.remove(removed_point)
-        del all_labels[removed_point]  # Remove the corresponding label
+    ann_image = renderer.composite(image)
 
-    session_state['all_points'] = all_points
-    session_state['all_labels'] = all_labels
+    # Convert the annotated image to a downloadable PNG format
+    image_buffer = io.BytesIO()
+    ann_image.save(image_buffer, format="PNG")
 
-    return all_points, all_labels
+    return image_buffer.getvalue()
 
 
-def update_ann_image(session_state, all_points, all_labels, image):
+def prepare_export(session_state, store, image, file_name):
     """
-    Overlays points on the image with colors corresponding to their labels 
-    and stores the result in the session state for display and download.
+    Generates the CSV, the report and the annotated image offered for
+    download. They are cached in the session state until the points change.
 
     Args:
-        session_state: dict containing `all_points` and `all_labels`.
-            - `all_points`: List of tuples representing points (x, y).
-            - `all_labels`: Dictionary mapping points to labels.
+        session_state: dict where the downloads are cached.
+        store: PointStore with the annotated points.
         image: PIL.Image object representing the base image.
-    """
+        file_name (str): Name of the image, without extension.
 
-    # Define colors for each label
-    label_colors = {
-        0: (255, 0, 0),  # Red
-        1: (0, 255, 0),  # Green
-        2: (0, 0, 255),  # Blue
-        # Add more labels and their colors as needed
-    }
-
-    # Create a drawable image
-    ann_image = image.copy()
-    draw = ImageDraw.Draw(ann_image)
-
-    # Draw each point with the corresponding color
-    point_radius = 7.5  # Radius of each point
-    for point in all_points:
-        x, y = point
-        label = all_labels.get(point, "default")  # Get the label for the point
-        color = label_colors.get(label, (255, 255, 255))  # Default to white if label not found
-
-        # Draw the point as a filled circle
-        draw.ellipse(
-            [(x - point_radius, y - point_radius), (x + point_radius, y + point_radius)],
-            outline=color,
-            width=5,
-        )
-
-    # Convert the annotated image to a downloadable JPEG format
-    image_buffer = io.BytesIO()
-    ann_image.save(image_buffer, format="PNG")
-    image_buffer.seek(0)
+    Returns:
+        dict: The downloads, with the (file_name, store.version) they match.
+    """
+    version = (file_name, store.version)
+    export = session_state.get('export')
 
-    # Store the annotated image
-    session_state['ann_image'] = image_buffer
+    if export is None or export['version'] != version:
+        export = {
+            'version': version,
+            'csv_data': store.to_csv_bytes(),
+            'report_data': build_report(store, file_name),
+            'ann_image': build_ann_image(session_state, store, image),
+        }
+        session_state['export'] = export
 
+    return export
 
-def recover_session(session_state, all_points, all_labels, image, file_name):
 
-    session_state['all_points'] = all_points 
-    session_state['all_labels'] = all_labels 
+def recover_session(session_state, store, image, image_key):
 
-    update_patch_data(session_state, all_points, all_labels)
-    update_results(session_state, all_points, all_labels, file_name)
-    update_ann_image(session_state, all_points, all_labels, image)
+    # The points were just loaded from the storage, so they are not written
+    # back; the layer over the image is drawn from them on the next export
+    session_state['store'] = store
+    session_state['export'] = None
+    session_state['renderer'] = None
 
 
 def check_latest_session_log(log_path=LOG_FILE):
@@ -229,235 +268,309 @@ def store_latest_session_log(file_name, log_path=LOG_FILE):
         print(f"An error occurred: {e}")
 
 
-def check_files(image_file_name, folder_path):
+def has_annotations(image_key):
     """
-    Checks if a file (without its extension) exists in the specified folder.
+    Checks if points of an image were saved before. They are stored under
+    the hash of the image, so they are found whatever name it was uploaded
+    with.
 
     Args:
-        image_file_name (str): The name of the file to check (without extension).
-        folder_path (str): The path of the folder to search in. Default is "/path/to/your/folder".
+        image_key (str): Key of the image in the image store.
 
     Returns:
-        bool: True if the file (ignoring extensions) exists, False otherwise.
+        bool: True if the image has saved annotations, False otherwise.
     """
-    # Normalize the file name to search (strip extension if any)
-    image_file_base = os.path.splitext(image_file_name)[0]
+    if STORAGE_BACKEND == "sqlite":
+        return open_database().has_image(ANNOTATOR_NAME, image_key)
+
+    return any(
+        os.path.exists(shard_path(ANN_DIR, image_key, suffix))
+        for suffix in (".csv", ".journal", ".journal.old")
+    )
 
-    # List all files in the folder without their extensions
-    file_names_in_folder = [
-        os.path.splitext(f)[0]
-        for f in os.listdir(folder_path)
-        if os.path.isfile(os.path.join(folder_path, f))
-    ]
 
-    # Check if the file exists (case-sensitive)
-    return image_file_base in file_names_in_folder
+def migrate_legacy_images():
+    """
+    Moves the images stored by file name by older versions to the image
+    store, and moves their annotations and reports next to them, named after
+    their hash.
+    """
+    for base_name, image_key in image_store.adopt_legacy().items():
+        if STORAGE_BACKEND == "sqlite":
+            open_database().rename_image(ANNOTATOR_NAME, base_name, image_key)
+        renames = [
+            (f"{ANN_DIR}/{base_name}.csv", shard_path(ANN_DIR, image_key, ".csv")),
+            (f"{REPORT_DIR}/{base_name}.txt", shard_path(REPORT_DIR, image_key, ".txt")),
+        ]
+        for old_path, new_path in renames:
+            if os.path.exists(old_path) and not os.path.exists(new_path):
+                Path(new_path).parent.mkdir(parents=True, exist_ok=True)
+                os.replace(old_path, new_path)
 
 
 def read_results_from_csv(csv_filename):
     """
     Reads the contents of a CSV file created by the `update_results` function
-    and extracts all_points and all_labels.
+    into a PointStore, and replays the edits journaled since it was written.
+    With the SQLite backend, the points of the image are read from the
+    database instead.
 
     Args:
         csv_filename (str): Path to the CSV file to read.
 
     Returns:
-        tuple: A tuple containing:
-            - all_points (list of tuples): List of points [(x1, y1), (x2, y2), ...].
-            - all_labels (list): List of labels corresponding to each point.
+        PointStore: The stored points and their labels.
     """
-    all_points = set()
-    all_labels = {}
+    if STORAGE_BACKEND == "sqlite":
+        base_name = os.path.splitext(os.path.basename(csv_filename))[0]
+        return open_database().load_points(ANNOTATOR_NAME, base_name, label_list)
 
-    try:
-        with open(csv_filename, mode="r", encoding="utf-8") as csv_file:
-            csv_reader = csv.DictReader(csv_file)  # Read CSV with headers
-            for row in csv_reader:
-                # Extract X, Y, and Label, and reconstruct all_points and all_labels
-                x = int(row["X"])
-                y = int(row["Y"])
-                label_id = label_list.index(row["Label"])
-                point_tuple = (x, y)
-
-                all_points.add(point_tuple)
-                all_labels[point_tuple] = label_id  # Store the label for this point
+    store = PointStore(label_list)
 
-    except FileNotFoundError:
-        print(f"Error: File '{csv_filename}' not found.")
+    try:
+        # The snapshot and the edits journaled since it was written are read
+        # together, so a compaction running meanwhile cannot drop any of them
+        open_journal(csv_filename, label_list).load(store)
     except Exception as e:
         print(f"Error reading the file: {e}")
     
-    return all_points, all_labels
+    return store
 
 
-def get_image():
+def get_image(session_state):
 
     image = None     
     image_file_name = None
     img_path = None
+    image_key = None
 
     # Image upload
     uploaded_file = st.file_uploader("Subir imagen ", type=["jpg", "jpeg", "png"])
 
     if uploaded_file is not None:
         image_file_name = uploaded_file.name
+
+        # Each upload is stored once, on the run it arrives
+        upload = session_state.get('upload')
+        if upload is None or upload[0] != uploaded_file.file_id:
+            upload = (uploaded_file.file_id, image_store.add(uploaded_file, image_file_name))
+            session_state['upload'] = upload
+        image_key = upload[1]
+
         image = Image.open(uploaded_file)
-        img_path = f"{IMAGE_DIR}/{image_file_name}"
+        img_path = image_store.path(image_key)
 
     # No image was uploaded - We use the latest one from a previous session
     else: 
         # Check latest image
         latest_image = check_latest_session_log()
-        result = check_files(latest_image, IMAGE_DIR)
+        image_key = image_store.resolve(latest_image)
 
-        if result:
+        if image_key is not None:
             # Recover the latest image
-            image_file_name = latest_image
-            image_path = f"{IMAGE_DIR}/{latest_image}"
+            image_file_name = image_store.name(image_key)
+            image_path = image_store.path(image_key)
             if os.path.exists(image_path):
                 image = Image.open(image_path)
                 img_path = image_path
             else:
+                image_key = None
                 st.error(f"Error: File '{image_path}' not found.")
         else:
             st.error("No image found in the latest session log.")
 
-    return image, image_file_name, img_path    
+    return image, image_file_name, img_path, image_key
 
 
-def handle_new_image(session_state, image, image_file_name, img_path):
+def handle_new_image(session_state, image, image_file_name, img_path, image_key):
 
-    # We update the name of the current image
+    # We update the current image
     session_state['image_file_name'] = image_file_name
+    session_state['image_key'] = image_key
 
-    # We check if the image was previously annotated
-    result = check_files(image_file_name, IMAGE_DIR)
-
-    if result: # Recover previous annotations
-        base_name = os.path.splitext(image_file_name)[0]
-        csv_file_name = f"{ANN_DIR}/{base_name}.csv"
-        all_points, all_labels = read_results_from_csv(csv_file_name)
-        recover_session(session_state, all_points, all_labels, image, base_name)
+    # We check if the image was previously annotated, under any name
+    if has_annotations(image_key): # Recover previous annotations
+        csv_file_name = shard_path(ANN_DIR, image_key, ".csv")
+        store = read_results_from_csv(csv_file_name)
+        recover_session(session_state, store, image, image_key)
 
-    else: # We store a backup of the image
-        Path(img_path).parent.mkdir(parents=True, exist_ok=True)
-        image.save(img_path)
+    else:
         init_session(session_state)
 
-    # We log the name of the image for session backups
-    store_latest_session_log(image_file_name)
+    # We log the image for session backups
+    store_latest_session_log(image_key)
 
 
-def image_ann(session_state):
+@st.fragment
+def control_panel(session_state):
+    """
+    Action and class selectors, in the sidebar. Changing them reruns the
+    app, as the canvas fragment has to pick them up.
+    """
 
-    st.sidebar.header("Seleccionar zoom")
-    with st.sidebar:
-        zoom = st.number_input(
-            "Zoom", 
-            min_value=1, 
-            max_value=4, 
-            value=1, 
-            step=1
-        )            
+    col1, col2 = st.columns(2)
+    with col1:
+        action = st.selectbox("Acción:", actions)
+    with col2:
+        label = st.selectbox("Clase:", label_list)
 
-    # Sidebar content
-    st.sidebar.header("Anotación de imágenes")
-    with st.sidebar:
-        col1, col2 = st.columns([2, 2])
-        with col1:
-            session_state['action'] = st.selectbox("Acción:", actions)
+    changed = 'action' in session_state and (session_state['action'], session_state['label']) != (action, label)
+    session_state['action'], session_state['label'] = action, label
+    if changed:
+        st.rerun()
 
-        with col2:
-            session_state['label'] = st.selectbox("Clase:", label_list)
 
+@st.fragment
+def annotation_canvas(session_state, image, image_key, img_path):
+    """
+    Canvas of the image. Committing points on the canvas only reruns this
+    fragment, not the upload nor the results panel.
+    """
 
-    image, image_file_name, img_path = get_image()
+    try:
+        store = session_state['store']
 
-    if image_file_name is not None:
+        # Translate the selected action
+        action = session_state['action']
+        if action == actions[1]:
+            mode = 'Del'
+        else:
+            mode = 'Transform'
+
+
+    # User got disconnected - We recover the previous session
+    except KeyError:
+        csv_file_name = shard_path(ANN_DIR, image_key, ".csv")
+        store = read_results_from_csv(csv_file_name)
+        recover_session(session_state, store, image, image_key)
+
+        mode  = 'Transform'
+
+
+    # Use pointdet to annotate the image
+    new_labels = pointdet(
+        image_path=img_path,
+        label_list=label_list,
+        point_store=store,
+        width = image.size[0],
+        height = image.size[1],
+        use_space=True,
+        key=img_path,
+        mode = mode,
+        label = session_state['label'],
+        point_width=5,
+        zoom=1,
+        tile_dir=TILE_DIR,
+        sync_interval_ms=1000,
+        sync_every_n_ops=10,
+        id_allocator=lambda count: reserve_point_ids(image_key, count)
+    )
+
+    # Update points and labels in session state if any changes are made
+    if new_labels is not None:
+
+        # Incorporate the new labels
+        changes = update_annotations(new_labels, store)
+
+        # Update results
+        update_results(session_state, store, image_key, changes)
+        update_ann_image(session_state, store, image, changes)
+
+        # The results panel is rerun once when the points change, so it no
+        # longer offers the downloads and saving status of the previous ones
+        if session_state.get('results_version') not in (None, store.version) and not session_state.get('results_stale'):
+            session_state['results_stale'] = True
+            st.rerun()
+
+
+@st.fragment
+def results_panel(session_state, image):
+    """
+    Saving status and downloads. It does not poll: it is refreshed on demand
+    by its buttons, so the downloads are only registered again when the user
+    asks for them. The canvas reruns it once when the points change, to mark
+    what it shows as stale.
+    """
 
-        # Check if a new image is uploaded
-        if 'image_file_name' not in session_state or session_state['image_file_name'] != image_file_name:
-            handle_new_image(session_state, image, image_file_name, img_path)
+    image_name = os.path.splitext(session_state['image_file_name'])[0]
+
+    # Saving status of the results
+    persistence = get_persistence_service()
+    image_key = session_state.get('image_key')
+    if session_state.get('results_stale'):
+        st.caption("Hay cambios nuevos: actualiza el estado")
+    elif persistence.failed(ANNOTATOR_NAME, image_key):
+        st.error("Error al guardar los resultados")
+    elif persistence.busy(ANNOTATOR_NAME, image_key):
+        st.caption("Guardando...")
+    else:
+        st.caption("Resultados guardados")
+    st.button("Actualizar estado", on_click=session_state.update, kwargs={'results_stale': False})
+
+    # The downloads are generated on demand, once per version of the points
+    store = session_state.get('store')
+    session_state['results_version'] = store.version if store is not None else None
+    export = session_state.get('export')
+    if store is not None and (export is None or export['version'] != (image_name, store.version)):
+        export = None
+        if image is not None and st.button("Preparar descargas", on_click=session_state.update, kwargs={'results_stale': False}):
+            with st.spinner("Preparando descargas..."):
+                export = prepare_export(session_state, store, image, image_name)
+
+    if export is not None:
+        # **1st Download Button** - CSV Annotations
+        st.download_button(
+            label="Descargar anotaciones (CSV)",
+            data=export['csv_data'],
+            file_name=f"{image_name}.csv",
+            mime="text/csv"
+        )
 
-        try:
-            all_points = session_state['all_points']
-            all_labels = session_state['all_labels']
+        # **2nd Download Button** - Annotation Report
+        st.download_button(
+            label="Descargar reporte (txt)",
+            data=export['report_data'],
+            file_name=f'{image_name}.txt',
+            mime='text/plain'
+        )
 
-            # Translate the selected action
-            action = session_state['action']
-            if action == actions[1]:
-                mode = 'Del'
-            else:
-                mode = 'Transform'
-
-
-        # User got disconnected - We recover the previous session
-        except KeyError:
-            base_name = os.path.splitext(image_file_name)[0]
-            csv_file_name = f"{ANN_DIR}/{base_name}.csv"
-            all_points, all_labels = read_results_from_csv(csv_file_name)
-            recover_session(session_state, all_points, all_labels, image, base_name)
-
-            mode  = 'Transform'
-
-
-        update_patch_data(session_state, all_points, all_labels)
-                    
-        # Use pointdet to annotate the image
-        new_labels = pointdet(
-            image_path=img_path,
-            label_list=label_list,
-            points=session_state['points'],
-            labels=session_state['labels'],
-            width = image.size[0],
-            height = image.size[1],
-            use_space=True,
-            key=img_path,
-            mode = mode,
-            label = session_state['label'],
-            point_width=5,
-            zoom=zoom,
+        # **3rd Download Button** - Annotated Image
+        st.download_button(
+            label="Descargar imagen anotada (png)",
+            data=export['ann_image'],
+            file_name=f'{image_name}_annotated.png',
+            mime='image/png'
         )
-        
-        # Update points and labels in session state if any changes are made
-        if new_labels is not None:
 
-            # Incorporate the new labels
-            all_points, all_labels = update_annotations(new_labels, all_points, all_labels, session_state)
 
-            # Update results
-            base_name = os.path.splitext(image_file_name)[0]
-            update_results(session_state, all_points, all_labels, base_name)
-            update_ann_image(session_state, all_points, all_labels, image)
+def image_ann(session_state):
+
+    create_dirs()
+    migrate_legacy_images()
+
+    # Sidebar content
+    st.sidebar.header("Anotación de imágenes")
+    with st.sidebar:
+        st.caption("Zoom con la rueda del ratón o pellizcando la imagen; arrastrar para desplazarla.")
+
+
+    image, image_file_name, img_path, image_key = get_image(session_state)
 
+    if image_key is not None:
 
+        # Check if a new image is uploaded
+        if session_state.get('image_key') != image_key:
+            handle_new_image(session_state, image, image_file_name, img_path, image_key)
+
+        # The same image uploaded under another name keeps its annotations
+        session_state['image_file_name'] = image_file_name
+
+        with st.sidebar:
+            control_panel(session_state)
+        annotation_canvas(session_state, image, image_key, img_path)
 
     # Download results
     if 'image_file_name' in session_state:
         st.sidebar.header("Resultados")
         with st.sidebar:
-            image_name = os.path.splitext(session_state['image_file_name'])[0]
-            # **1st Download Button** - CSV Annotations
-            st.download_button(
-                label="Descargar anotaciones (CSV)",
-                data=session_state['csv_data'],
-                file_name=f"{image_name}.csv",
-                mime="text/csv"
-            )
-
-            # **2nd Download Button** - Annotation Report
-            st.download_button(
-                label="Descargar reporte (txt)",
-                data=session_state['report_data'],
-                file_name=f'{image_name}.txt',
-                mime='text/plain'
-            )
-
-            # **3rd Download Button** - Annotated Image
-            st.download_button(
-                label="Descargar imagen anotada (png)",
-                data=session_state['ann_image'],
-                file_name=f'{image_name}_annotated.png',
-                mime='image/png'
-            )
\ No newline at end of file
+            results_panel(session_state, image)
@@ -1,14 +1,14 @@
+import math
 import os
+from functools import lru_cache
 import streamlit.components.v1 as components
 from streamlit.components.v1.components import CustomComponent
 
 import streamlit as st
-import streamlit.elements.image as st_image
-from PIL import Image
-import numpy as np
-import matplotlib.pyplot as plt
-from hashlib import md5
+from streamlit import runtime
 from streamlit_image_annotation import IS_RELEASE
+from .image_cache import image_cache, fit_size
+from .tiles import TILE_SIZE, TILE_MIN_PIXELS, get_pyramid, prune_pyramids
 
 if IS_RELEASE:
     absolute_path = os.path.dirname(os.path.abspath(__file__))
@@ -17,61 +17,420 @@ if IS_RELEASE:
 else:
     _component_func = components.declare_component("st_point", url="http://localhost:3000")
 
+# Largest downsampling of the display image, as a power of two
+MAX_DISPLAY_DOWNSAMPLE = 16
+
+# Point ids reserved at a time for the new points of a canvas
+ID_BLOCK_SIZE = 256
+
+# Anchors of matplotlib's gist_rainbow colormap, (position, (r, g, b)),
+# sampled here so matplotlib is not imported for the default colors
+GIST_RAINBOW = (
+    (0.000, (1.00, 0.00, 0.16)),
+    (0.030, (1.00, 0.00, 0.00)),
+    (0.215, (1.00, 1.00, 0.00)),
+    (0.400, (0.00, 1.00, 0.00)),
+    (0.586, (0.00, 1.00, 1.00)),
+    (0.770, (0.00, 0.00, 1.00)),
+    (0.954, (1.00, 0.00, 1.00)),
+    (1.000, (1.00, 0.00, 0.75)),
+)
+PALETTE_SIZE = 256
+
+
+def _palette(anchors, size=PALETTE_SIZE):
+    """
+    Interpolates a colormap between its anchors into a table of `size`
+    colors, with the same arithmetic as matplotlib's lookup tables so the
+    colors match to the bit.
+    """
+    xs = [x * (size - 1) for x, _ in anchors]
+    palette = [anchors[0][1]]
+    for i in range(1, size - 1):
+        x = i * (1 / (size - 1)) * (size - 1)
+        k = next(k for k, anchor in enumerate(xs) if anchor >= x)
+        t = (x - xs[k - 1]) / (xs[k] - xs[k - 1])
+        palette.append(tuple(t * (c1 - c0) + c0 for c0, c1 in zip(anchors[k - 1][1], anchors[k][1])))
+    palette.append(anchors[-1][1])
+    return palette
+
+
+PALETTES = {'gist_rainbow': _palette(GIST_RAINBOW)}
+
+
+@lru_cache(maxsize=64)
+def _colormap(label_names, colormap_name, label_colors):
+    if label_colors is not None:
+        return tuple(f'rgb({r},{g},{b})' for (r, g, b) in label_colors[:len(label_names)])
+
+    if colormap_name in PALETTES:
+        palette = PALETTES[colormap_name]
+        sample = lambda x: palette[min(int(x * len(palette)), len(palette) - 1)]
+    else:
+        # Other colormaps still come from matplotlib, imported on first use
+        import matplotlib
+        sample = matplotlib.colormaps[colormap_name]
+
+    colors = []
+    for idx in range(len(label_names)):
+        r, g, b = sample(float(idx)/len(label_names))[:3]
+        colors.append('#%02x%02x%02x' % (int(r * 255), int(g * 255), int(b * 255)))
+    return tuple(colors)
+
+
 def get_colormap(label_names, colormap_name='gist_rainbow', label_colors=None):
-    if label_colors is None:
-        colormap = {} 
-        cmap = plt.get_cmap(colormap_name)
-        for idx, l in enumerate(label_names):
-            rgb = [int(d) for d in np.array(cmap(float(idx)/len(label_names)))*255][:3]
-            colormap[l] = ('#%02x%02x%02x' % tuple(rgb))
-        return colormap
+    """
+    Color of each label: the given RGB colors, or colors sampled evenly from
+    a colormap. Computed once per set of labels.
+    """
+    if label_colors is not None:
+        label_colors = tuple(tuple(color) for color in label_colors)
+    colors = _colormap(tuple(label_names), colormap_name, label_colors)
+    return dict(zip(label_names, colors))
+
+def _media_url(data, mimetype, coordinates, version):
+    """
+    Registers image bytes as a media file of the current session and returns
+    its URL.
+
+    The media file id is a hash of the bytes, so the URL only changes with
+    the image. The `v` query argument makes the media handler (a tornado
+    StaticFileHandler) send long-lived cache headers, so browsers fetch the
+    image once across reruns and sessions.
+    """
+    if not runtime.exists():
+        return ""
+    url = runtime.get_instance().media_file_mgr.add(data, mimetype, coordinates)
+    return f"{url}?v={version}"
+
+
+def _tile_urls(pyramid, key, view):
+    """
+    Registers the tiles of the overview level and those around the view
+    reported by the canvas ({'level', 'x0', 'y0', 'x1', 'y1'}, in
+    full-resolution pixels), and returns their URLs by "level/col/row".
+    Tiles outside the view are not registered, so the browser never holds
+    more than a few screens of them. The media files of a session only last
+    until the next run that does not register them, so the tiles in view are
+    registered on every run, from the bytes kept in memory by `read_tile`.
+    Only the levels of the pyramid already written are registered.
+    """
+    ready = pyramid.ready.copy()
+    wanted = set(pyramid.tiles(pyramid.overview_level)) if pyramid.overview_level in ready else set()
+    if view is not None and ready:
+        level = min(max(int(view['level']), 0), len(pyramid.levels) - 1)
+        # While the pyramid is built, the finest level written so far
+        # stands in for the level of the view
+        level = min((ready_level for ready_level in ready if ready_level >= level), default=max(ready))
+        margin = TILE_SIZE * 2**level
+        wanted.update(pyramid.tiles(level, (view['x0'] - margin, view['y0'] - margin, view['x1'] + margin, view['y1'] + margin)))
+
+    urls = {}
+    for level, col, row in sorted(wanted):
+        data = pyramid.read_tile(level, col, row)
+        urls[f"{level}/{col}/{row}"] = _media_url(data, "image/jpeg", f"point-{key}-tile-{level}-{col}-{row}", pyramid.key).lstrip('/')
+    return urls
+
+
+def _sync_state(key):
+    """
+    Returns the delta-protocol state of the pointdet component with the given
+    key, kept in the session across reruns.
+    """
+    sync_states = st.session_state.setdefault('pointdet_sync', {})
+    return sync_states.setdefault(key, {
+        'mount_id': None,       # Mount of the canvas that sent the last ops
+        'seq': 0,               # Last client op applied
+        'server_version': 0,    # Last server op queued
+        'server_ops': [],       # Server ops not yet acknowledged by the canvas
+        'need_snapshot': True,  # Whether the canvas needs the full point list
+        'snapshot_request': None,   # Last snapshot request of the canvas (mount, number)
+        'snapshot_served': None,    # Last snapshot request answered with the point list
+        'id_request': None,     # Last request of point ids of the canvas (mount, number)
+        'ids_served': None,     # Last request of point ids answered with a block
+        'id_block': None,       # Point ids [first, end) reserved for a mount of the canvas
+        'downsample': None,     # Downsampling of the display image served
+    })
+
+
+def _component_value(key):
+    """
+    Returns the last value sent by the pointdet canvas with the given key,
+    which Streamlit keeps in the session state before the component runs.
+    """
+    return st.session_state.get(key) if key is not None else None
+
+
+def _track_mount(component_value, sync):
+    """
+    Updates `sync` with the mount of the canvas and whether it needs the full
+    point list, from the value it sent last. Done before rendering the
+    component, so a canvas that asks for a snapshot (e.g. remounted when the
+    user comes back to the annotator) gets it in the same run.
+
+    The value of the component stays in the session until the canvas sends
+    another one, so each snapshot or id request (numbered per mount) is
+    answered once; the reruns in between do not send the point list again.
+    """
+    if component_value is None:
+        # Nothing sent yet: the canvas is mounted by this run. The value of a
+        # canvas that was not rendered in the last run is dropped by
+        # Streamlit, so a known mount means the canvas was remounted
+        if sync['mount_id'] is not None:
+            sync['mount_id'] = None
+            sync['seq'] = 0
+            sync['snapshot_served'] = None
+            sync['ids_served'] = None
+        sync['snapshot_request'] = (None, 0)
+        sync['id_request'] = (None, 0)
+        sync['need_snapshot'] = sync['snapshot_served'] != sync['snapshot_request']
+        return
+    if not isinstance(component_value, dict):
+        return
+
+    # A remounted canvas numbers its ops from scratch
+    if component_value['mount_id'] != sync['mount_id']:
+        if sync['mount_id'] is None and sync['ids_served'] == (None, 0):
+            # The first block was reserved before the canvas sent its mount
+            sync['ids_served'] = (component_value['mount_id'], 0)
+            sync['id_block']['mount_id'] = component_value['mount_id']
+        sync['mount_id'] = component_value['mount_id']
+        sync['seq'] = 0
+    sync['id_request'] = (component_value['mount_id'], component_value.get('id_request', 0))
+    sync['snapshot_request'] = (component_value['mount_id'], component_value.get('snapshot_request', 0))
+    sync['need_snapshot'] = (
+        component_value.get('need_snapshot', False)
+        and sync['snapshot_served'] != sync['snapshot_request']
+    )
+
+
+def _viewport(key):
+    """
+    Returns the viewport last reported by a pointdet canvas of the session
+    ({'width': CSS pixels, 'pixel_ratio': device pixels per CSS pixel,
+    'zoom': zoom of the canvas}), or None before any canvas has reported it.
+
+    The canvas sends it along with its ops; the value of the component is
+    read before rendering it, so the display image fits the new viewport in
+    the same run.
+    """
+    component_value = _component_value(key)
+    if isinstance(component_value, dict) and component_value.get('viewport'):
+        st.session_state['pointdet_viewport'] = component_value['viewport']
+    return st.session_state.get('pointdet_viewport')
 
+
+def _display_downsample(size, viewport, zoom):
+    """
+    Returns the power of two by which the display image can be downsampled
+    and still have a device pixel per screen pixel of the canvas, which is
+    scaled to the viewport width and then zoomed.
+    """
+    if viewport is None:
+        return 1
+    needed = min(viewport['width'], size[0]) * zoom * viewport.get('pixel_ratio', 1)
+    downsample = 1
+    while downsample < MAX_DISPLAY_DOWNSAMPLE and size[0] / (downsample * 2) >= needed:
+        downsample *= 2
+    return downsample
+
+
+def _scale_op(op, scale):
+    if 'point' not in op:
+        return dict(op)
+    return {**op, 'point': [b * scale for b in op['point']]}
+
+
+def push_ops(key, ops):
+    """
+    Queues ops (bulk relabels, pre-annotations, ...) to be applied by the
+    mounted pointdet canvas with the given key, without remounting it.
+
+    Args:
+        key (str): Key of the pointdet component.
+        ops (list): Ops in full-resolution coordinates, each with an `op`
+            ('add', 'move', 'delete' or 'relabel'), the point `id` and, as
+            needed, its `point` [x, y] and `label_id`. The caller applies the
+            same ops to its own point storage.
+    """
+    sync = _sync_state(key)
+    for op in ops:
+        sync['server_version'] += 1
+        sync['server_ops'].append({**op, 'version': sync['server_version']})
+
+
+def _receive(component_value, sync, scale):
+    """
+    Returns the client ops of `component_value` not applied yet, in
+    full-resolution coordinates, and acknowledges them. The mount of the
+    canvas was already tracked by `_track_mount`.
+    """
+    if component_value is None:
+        return None
+
+    # Full point list sent by older builds of the frontend
+    if isinstance(component_value, list):
+        sync['need_snapshot'] = True
+        return [{'point':[b*scale for b in item['point']], 'label_id': item['label_id'], 'label': item['label'], 'id': item.get('id')} for item in component_value]
+
+    # Forget the server ops the canvas already applied
+    applied_version = component_value.get('server_version', 0)
+    sync['server_ops'] = [op for op in sync['server_ops'] if op['version'] > applied_version]
+
+    ops = [op for op in component_value.get('ops', []) if op['seq'] > sync['seq']]
+    if not ops:
+        return None
+    sync['seq'] = max(op['seq'] for op in ops)
+
+    return [_scale_op(op, scale) for op in ops]
+
+
+def pointdet(image_path, label_list, points=None, labels=None, height=512, width=512, point_width=3, use_space=False, key=None, mode=None, label=None, zoom=2, label_colors=None, point_store=None, sync_interval_ms=0, sync_every_n_ops=1, tile_dir=None, tile_min_pixels=TILE_MIN_PIXELS, id_allocator=None) -> CustomComponent:
+    """
+    Renders the point annotation canvas.
+
+    The canvas and Python exchange versioned op lists instead of the whole
+    point list: the full list (`points_info`) is only sent when the canvas
+    mounts, the canvas sends the ops made since the last acknowledged one, and
+    ops queued with `push_ops` are applied by the mounted canvas.
+
+    Each batch of ops sent by the canvas reruns the script. With
+    `sync_interval_ms` > 0 the canvas coalesces its ops and sends them once
+    `sync_interval_ms` have passed since the first unsent op, once
+    `sync_every_n_ops` ops are waiting, or when the canvas loses focus (blur,
+    mouse leaving the frame, space bar), whichever comes first.
+
+    The canvas keeps the size of the image fitted to the viewport width;
+    `zoom` is its initial zoom, changed afterwards in the browser with the
+    mouse wheel or a pinch, and dragging pans it. The image drawn under the
+    points is downsampled by a power of two to the viewport width times the
+    zoom of the canvas, and a sharper one is only fetched when zooming in.
+    Coordinates are not affected.
+
+    With `tile_dir`, images of at least `tile_min_pixels` pixels are cut into
+    a pyramid of JPEG tiles cached in that directory, and the canvas only
+    loads the tiles in view, so slide-sized images fit in the browser.
+    Smaller images are served whole as above.
+
+    The canvas mints the ids of the points it adds. Without `id_allocator`
+    they follow the largest id it knows of, so two sessions annotating the
+    same image can mint the same id. `id_allocator(count)` reserves `count`
+    consecutive ids in the storage of the points and returns the first one;
+    with it, the canvas mints its ids from blocks of ID_BLOCK_SIZE ids
+    reserved for it, and asks for the next block before running out.
+
+    Returns:
+        list or None: The new client ops, in full-resolution coordinates, each
+            with an `op`, the point `id` and, as needed, its `point` and
+            `label_id`. None when there are no new ops. Older builds of the
+            frontend return their full point list instead.
+    """
+    sync = _sync_state(key)
+    component_value = _component_value(key)
+    _track_mount(component_value, sync)
+
+    # Points are exchanged in the space of the image fitted in (width,
+    # height); the display image drawn under them is only as large as the
+    # viewport and zoom need. Until the canvas reports its viewport the full
+    # image is served (older builds of the frontend never report it)
+    original_size = image_cache.image_size(image_path)
+    image_size = fit_size(original_size, width, height)
+    scale = original_size[0]/image_size[0]
+
+    # The canvas zooms on its own from the initial `zoom`, and reports it
+    shown_zoom = zoom
+    if isinstance(component_value, dict) and component_value.get('viewport'):
+        shown_zoom = component_value['viewport'].get('zoom', zoom)
+
+    viewport = _viewport(key)
+    downsample = _display_downsample(image_size, viewport, shown_zoom)
+    if viewport is not None:
+        # Never downsampled again once a sharper image was served, so
+        # zooming out does not fetch a new image
+        if sync['downsample'] is not None:
+            downsample = min(downsample, sync['downsample'])
+        sync['downsample'] = downsample
+
+    # Tiles are only used for large images, and by builds of the frontend
+    # that report their viewport; the others get the whole image. A tiled
+    # image is never decoded here: its pyramid is built in the background,
+    # and the canvas polls while it is `pending`
+    tiles = None
+    tiled = tile_dir is not None and original_size[0] * original_size[1] >= tile_min_pixels
+    if tiled and viewport is None:
+        image_url, display_size = '', image_size
+    elif tiled:
+        pyramid = get_pyramid(image_path, tile_dir)
+        if pyramid.error is not None:
+            raise pyramid.error
+        view = component_value.get('view') if isinstance(component_value, dict) else None
+        tiles = {
+            'tile_size': TILE_SIZE,
+            'scale': scale,
+            'levels': pyramid.levels,
+            'urls': _tile_urls(pyramid, key, view),
+            'pending': not pyramid.complete,
+        }
+        image_url, display_size = '', image_size
     else:
-        return {label: f'rgb({r},{g},{b})' for label, (r, g, b) in zip(label_names, label_colors)}
-
-def pointdet(image_path, label_list, points=None, labels=None, height=512, width=512, point_width=3, use_space=False, key=None, mode=None, label=None, zoom=2, label_colors=None) -> CustomComponent:
-    image = Image.open(image_path)
-    original_image_size = image.size
-    image.thumbnail(size=(width, height))
-    resized_image_size = image.size
-    scale = original_image_size[0]/resized_image_size[0]
-    
-    image_url = st_image.image_to_url(image, image.size[0], True, "RGB", "PNG", f"point-{md5(image.tobytes()).hexdigest()}-{key}")
-    if image_url.startswith('/'):
-        image_url = image_url[1:]
+        # Read, and resized and encoded if needed, once per file and display size
+        display = image_cache.get(image_path, math.ceil(image_size[0]/downsample), math.ceil(image_size[1]/downsample))
+        display_size = display.size
+
+        # The media file is registered on every run, from the cached bytes
+        image_url = _media_url(display.data, display.mimetype, f"point-{key}", display.digest)
+        display.url = image_url
+        if image_url.startswith('/'):
+            image_url = image_url[1:]
 
     if label_colors is None:
         color_map = get_colormap(label_list, colormap_name='gist_rainbow')
     else:
         color_map = get_colormap(label_list, label_colors=label_colors)
-        
-    points_info = [{'point':[b/scale for b in item[0]], 'label_id': item[1], 'label': label_list[item[1]]} for item in zip(points, labels)]
-    component_value = _component_func(image_url=image_url, image_size=image.size, label_list=label_list, points_info=points_info, color_map=color_map, point_width=point_width, use_space=use_space, key=key, mode=mode, label=label, zoom=zoom)
-    if component_value is not None:
-        component_value = [{'point':[b*scale for b in item['point']], 'label_id': item['label_id'], 'label': item['label']}for item in component_value]
-    return component_value
+
+    # The full point list only travels when the canvas needs a snapshot
+    points_info = None
+    if sync['need_snapshot']:
+        if point_store is not None:
+            # Vectorised rescaling of the stored points
+            points_info = point_store.as_payload(scale)
+        else:
+            points_info = [{'point':[b/scale for b in item[0]], 'label_id': item[1], 'label': label_list[item[1]], 'id': i + 1} for i, item in enumerate(zip(points, labels))]
+        sync['snapshot_served'] = sync['snapshot_request']
+
+    # Ids for the new points of the canvas, reserved once per request
+    if id_allocator is not None and sync['ids_served'] != sync['id_request']:
+        first = int(id_allocator(ID_BLOCK_SIZE))
+        sync['id_block'] = {'mount_id': sync['id_request'][0], 'first': first, 'end': first + ID_BLOCK_SIZE}
+        sync['ids_served'] = sync['id_request']
+
+    server_ops = [_scale_op(op, 1/scale) for op in sync['server_ops']]
+    ack = {'mount_id': sync['mount_id'], 'seq': sync['seq']}
+
+    component_value = _component_func(image_url=image_url, image_size=image_size, display_size=display_size, viewport_known=viewport is not None, tiles=tiles, label_list=label_list, points_info=points_info, snapshot_version=sync['server_version'], server_ops=server_ops, ack=ack, id_block=sync['id_block'], color_map=color_map, point_width=point_width, use_space=use_space, sync_interval_ms=sync_interval_ms, sync_every_n_ops=sync_every_n_ops, key=key, mode=mode, label=label, zoom=zoom)
+    return _receive(component_value, sync, scale)
 
 if not IS_RELEASE:
     from glob import glob
-    import pandas as pd
+    from annotation_core import PointStore, apply_ops
     label_list = ['deer', 'human', 'dog', 'penguin', 'framingo', 'teddy bear']
     image_path_list = glob('image/*.jpg')
     if 'result_dict' not in st.session_state:
         result_dict = {}
         for img in image_path_list:
-            result_dict[img] = {'points': [[0,0],[50,150], [200,200]],'labels':[0,3,4]}
+            result_dict[img] = PointStore(label_list)
+            result_dict[img].extend([0, 50, 200], [0, 150, 200], [0, 3, 4])
         st.session_state['result_dict'] = result_dict.copy()
 
 
     num_page = st.slider('page', 0, len(image_path_list)-1, 0)
     target_image_path = image_path_list[num_page]
-    new_labels = pointdet(image_path=target_image_path, 
+    store = st.session_state['result_dict'][target_image_path]
+    new_ops = pointdet(image_path=target_image_path, 
                            label_list=label_list, 
-                           points=st.session_state['result_dict'][target_image_path]['points'],
-                           labels=st.session_state['result_dict'][target_image_path]['labels'],
+                           point_store=store,
                            point_width=3, use_space=True, key=target_image_path)
 
-    if new_labels is not None:
-        st.session_state['result_dict'][target_image_path]['points'] = [v['point'] for v in new_labels]
-        st.session_state['result_dict'][target_image_path]['labels'] = [v['label_id'] for v in new_labels]
-    st.json(st.session_state['result_dict'])
\ No newline at end of file
+    if new_ops is not None:
+        apply_ops(new_ops, store)
+    st.json(store.as_payload())
\ No newline at end of file
@@ -1,20 +1,12 @@
-import React, { useState, useEffect } from "react"
-import { Circle, Rect, Text, Transformer } from 'react-konva';
+import React from "react"
+import { Circle } from 'react-konva';
+import type { PointItem } from './pointsModel'
 
-export interface RectProps {
-  x: number,
-  y: number,
-  width: number,
-  height: number,
-  id: string,
-  stroke: string,
-  label: string,
-}
 export interface BBoxProps {
-  rectProps: RectProps,
-  onChange: any,
+  rectProps: PointItem,
+  onChange: (point: PointItem) => void,
   isSelected: boolean,
-  onClick: any,
+  onClick: (point: PointItem) => void,
   scale: number,
   strokeWidth: number
 }
@@ -26,7 +18,7 @@ const Point = (props: BBoxProps)=>{
   return (
     <React.Fragment>
       <Circle
-        onClick={onClick}
+        onClick={() => onClick(rectProps)}
         {...rectProps}
         x={rectProps.x * scale}
         y={rectProps.y * scale}
@@ -47,4 +39,5 @@ const Point = (props: BBoxProps)=>{
 };
 
 
-export default Point;
\ No newline at end of file
+// Only re-rendered when its point or its (stable) callbacks change
+export default React.memo(Point);
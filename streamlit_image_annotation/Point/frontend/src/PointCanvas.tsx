@@ -1,120 +1,320 @@
-import React, { useEffect } from "react"
-import { Layer, Stage, Image } from 'react-konva';
+import React, { useCallback, useEffect, useRef, useState } from "react"
+import { Layer, Stage, Image, Shape } from 'react-konva';
 import Point from './Point'
 import Konva from 'konva';
+import type { PointOp } from './PointDet'
+import TileLayer, { TileSet, TileView, viewLevel } from './TileLayer'
+import { PointQuadtree } from './pointIndex'
+import type { PointItem, PointsAction } from './pointsModel'
+
+// Screen pixels around a point where a click still selects it
+const HIT_TOLERANCE = 8
+
+// Zoom factor of one wheel step, and screen pixels per image pixel at the
+// largest zoom
+const WHEEL_ZOOM = 1.1
+const MAX_PIXEL_ZOOM = 4
 
 export interface PointCanvasProps {
-  pointsInfo: any[],
+  points: Map<string, PointItem>,
+  loads: number,  // Changes when the points are replaced from outside
   mode: string,
   selectedId: string | null,
-  setSelectedId: any,
-  setPointsInfo: any,
-  setLabel: any,
+  dispatch: React.Dispatch<PointsAction>,
+  newPointId: () => string,
+  pushOps: (ops: PointOp[]) => void,
   color_map: any,
   scale: number,
   label: string,
   image_size: number[],
   image: any,
   strokeWidth: number
-  zoom: number
+  zoom: number,
+  setZoom: (zoom: number) => void,
+  tiles: TileSet | null,      // Tile pyramid, for a fixed-size panned stage
+  baseUrl: string | null,
+  onViewChange: (view: TileView) => void
 }
 
 const PointCanvas = (props: PointCanvasProps) => {
   const {
-    pointsInfo,
+    points,
+    loads,
     mode,
     selectedId,
-    setSelectedId,
-    setPointsInfo,
-    setLabel,
+    dispatch,
+    newPointId,
+    pushOps,
     color_map,
     scale,
     label,
     image_size,
     image,
     strokeWidth,
-    zoom
+    zoom,
+    setZoom,
+    tiles,
+    baseUrl,
+    onViewChange
   }: PointCanvasProps = props
-  
-  const checkDeselect = (e: any) => {
-    if (!(e.target instanceof Konva.Circle)) {
-      if (selectedId === null && mode === 'Transform') {
-        const pointer = e.target.getStage().getPointerPosition()
-        const points = pointsInfo.slice();
-        const new_id = Date.now().toString()
-        points.push({
-          x: pointer.x / (scale*zoom),
-          y: pointer.y / (scale*zoom),
-          label: label,
-          stroke: color_map[label],
-          id: new_id
-        })
-        setPointsInfo(points);
-        setSelectedId(new_id);
-      } else {
-        setSelectedId(null);
-      }
+
+  // Screen pixels per point coordinate. The stage keeps the size of the
+  // image fitted to the width, and zooming scales and pans what it draws
+  // instead of growing the canvas
+  const screenScale = scale * zoom
+  const stageWidth = image_size[0] * scale
+  const stageHeight = image_size[1] * scale
+  const maxZoom = Math.max(MAX_PIXEL_ZOOM / scale, 1)
+  const [stagePos, setStagePos] = useState({ x: 0, y: 0 })
+
+  const clampPos = (pos: { x: number, y: number }, ratio: number = screenScale) => {
+    return {
+      x: Math.min(0, Math.max(pos.x, stageWidth - image_size[0] * ratio)),
+      y: Math.min(0, Math.max(pos.y, stageHeight - image_size[1] * ratio))
     }
-  };
+  }
+
+  // Point of the stage kept in place by the next zoom change: the pointer
+  // for wheel and pinch zooms, the center otherwise
+  const zoomAnchor = useRef<{ x: number, y: number } | null>(null)
+  const zoomAt = (newZoom: number, anchor: { x: number, y: number }) => {
+    zoomAnchor.current = anchor
+    setZoom(Math.min(Math.max(newZoom, 1), maxZoom))
+  }
 
+  const lastScale = useRef(screenScale)
   useEffect(() => {
-    const points = pointsInfo.slice();
-    for (let i = 0; i < points.length; i++) {
-      if (points[i].x < 0 || points[i].y < 0) {
-        points[i].x = Math.max(0, points[i].x)
-        points[i].y = Math.max(0, points[i].y)
-        setPointsInfo(points)
-      }
-      if (points[i].x > image_size[0] || points[i].y > image_size[1]) {
-        points[i].x = Math.min(points[i].x, image_size[0])
-        points[i].y = Math.min(points[i].y, image_size[1])
-        setPointsInfo(points)
+    if (lastScale.current !== screenScale) {
+      const factor = screenScale / lastScale.current
+      const anchor = zoomAnchor.current ?? { x: stageWidth / 2, y: stageHeight / 2 }
+      setStagePos((pos) => clampPos({
+        x: anchor.x - (anchor.x - pos.x) * factor,
+        y: anchor.y - (anchor.y - pos.y) * factor
+      }))
+    }
+    zoomAnchor.current = null
+    lastScale.current = screenScale
+  }, [screenScale])
+
+  const handleWheel = (e: Konva.KonvaEventObject<WheelEvent>) => {
+    e.evt.preventDefault()
+    const pointer = e.target.getStage()?.getPointerPosition()
+    if (pointer) {
+      zoomAt(zoom * (e.evt.deltaY < 0 ? WHEEL_ZOOM : 1 / WHEEL_ZOOM), pointer)
+    }
+  }
+
+  // Two-finger pinch: zoom by the change of distance between the touches,
+  // around their midpoint
+  const pinchDistance = useRef<number | null>(null)
+  const handleTouchMove = (e: Konva.KonvaEventObject<TouchEvent>) => {
+    const touches = e.evt.touches
+    const stage = e.target.getStage()
+    if (touches.length !== 2 || !stage) {
+      return
+    }
+    e.evt.preventDefault()
+    if (stage.isDragging()) {
+      stage.stopDrag()
+    }
+    const box = stage.container().getBoundingClientRect()
+    const distance = Math.hypot(touches[0].clientX - touches[1].clientX, touches[0].clientY - touches[1].clientY)
+    if (pinchDistance.current !== null) {
+      zoomAt(zoom * distance / pinchDistance.current, {
+        x: (touches[0].clientX + touches[1].clientX) / 2 - box.left,
+        y: (touches[0].clientY + touches[1].clientY) / 2 - box.top
+      })
+    }
+    pinchDistance.current = distance
+  }
+
+  // Part of the image in view, in point coordinates
+  const visible = {
+    x0: -stagePos.x / screenScale,
+    y0: -stagePos.y / screenScale,
+    x1: (stageWidth - stagePos.x) / screenScale,
+    y1: (stageHeight - stagePos.y) / screenScale
+  }
+  const view: TileView | null = tiles ? {
+    level: viewLevel(tiles, screenScale),
+    x0: visible.x0 * tiles.scale,
+    y0: visible.y0 * tiles.scale,
+    x1: visible.x1 * tiles.scale,
+    y1: visible.y1 * tiles.scale
+  } : null
+
+  useEffect(() => {
+    if (view) {
+      onViewChange(view)
+    }
+  }, [view?.level, view?.x0, view?.y0, view?.x1, view?.y1])
+
+  // Only the points in view are drawn
+  const margin = strokeWidth * 3 / screenScale
+  const inView = (point: PointItem) => (
+    point.x >= visible.x0 - margin && point.x <= visible.x1 + margin
+    && point.y >= visible.y0 - margin && point.y <= visible.y1 + margin
+  )
+
+  // Points are hit-tested on a quadtree rather than on per-shape hit
+  // canvases. A click selects the nearest point within the tolerance, so
+  // dense points can be picked without an exact hit on their ring
+  const hitRadius = Math.max(strokeWidth * 1.5, HIT_TOLERANCE) / screenScale
+
+  // The tree follows the edits made here point by point, and is only
+  // rebuilt when the points are replaced from outside (snapshot, server
+  // ops) or the image size changes
+  const index = useRef<PointQuadtree | null>(null)
+  const indexedState = useRef('')
+  const indexState = loads + ':' + image_size.join('x')
+  if (index.current === null || indexedState.current !== indexState) {
+    index.current = new PointQuadtree(image_size[0], image_size[1], Array.from(points.values()))
+    indexedState.current = indexState
+  }
+  const tree = index.current
+
+  const clampPoint = (point: PointItem) => {
+    return {
+      ...point,
+      x: Math.min(Math.max(point.x, 0), image_size[0]),
+      y: Math.min(Math.max(point.y, 0), image_size[1])
+    }
+  }
+
+  const deletePoint = (point: PointItem) => {
+    tree.remove(point)
+    dispatch({ type: 'delete', id: point.id })
+    pushOps([{ op: 'delete', id: point.id }])
+  }
+
+  // The selected point gets callbacks that do not change between renders,
+  // so its memoised node only re-renders when the point itself changes
+  const current = useRef({ mode, points, tree, clampPoint, deletePoint })
+  current.current = { mode, points, tree, clampPoint, deletePoint }
+  const onSelectedClick = useCallback((point: PointItem) => {
+    if (current.current.mode === 'Del') {
+      current.current.deletePoint(point)
+    }
+  }, [])
+  const onSelectedChange = useCallback((newAttrs: PointItem) => {
+    const { points, tree, clampPoint } = current.current
+    const moved = clampPoint(newAttrs)
+    const point = points.get(moved.id)
+    if (point !== undefined) {
+      tree.move(point, moved)
+    }
+    dispatch({ type: 'move', id: moved.id, x: moved.x, y: moved.y })
+    pushOps([{ op: 'move', id: moved.id, x: moved.x, y: moved.y }])
+  }, [dispatch, pushOps])
+
+  const selectedPoint = selectedId !== null ? points.get(selectedId) : undefined
+
+  const handlePointer = (e: any) => {
+    // The selected point handles its own events, to be dragged
+    if (e.target instanceof Konva.Circle) {
+      return
+    }
+    const pointer = e.target.getStage().getRelativePointerPosition()
+    const x = pointer.x / screenScale
+    const y = pointer.y / screenScale
+
+    const hit = tree.nearest(x, y, hitRadius)
+    if (hit !== null) {
+      if (mode === 'Transform') {
+        dispatch({ type: 'select', id: hit.id });
+      } else if (mode === 'Del') {
+        deletePoint(hit);
       }
+    } else if (selectedId === null && mode === 'Transform') {
+      const new_id = newPointId()
+      const new_point = clampPoint({
+        x: x,
+        y: y,
+        label: label,
+        stroke: color_map[label],
+        id: new_id
+      })
+      tree.insert(new_point);
+      dispatch({ type: 'add', point: new_point });
+      pushOps([{ op: 'add', ...new_point }]);
+      dispatch({ type: 'select', id: new_id });
+    } else {
+      dispatch({ type: 'select', id: null });
     }
-  }, [pointsInfo, image_size])
+  };
+
+  // All the points but the selected one are drawn by a single shape, one
+  // path per label, without listeners
+  const drawPoints = (context: Konva.Context) => {
+    const groups = new Map<string, PointItem[]>()
+    points.forEach((point) => {
+      if (point.id !== selectedId && inView(point)) {
+        const group = groups.get(point.stroke)
+        if (group) {
+          group.push(point)
+        } else {
+          groups.set(point.stroke, [point])
+        }
+      }
+    })
+    groups.forEach((group, stroke) => {
+      context.beginPath()
+      group.forEach((point) => {
+        const x = point.x * screenScale
+        const y = point.y * screenScale
+        context.moveTo(x + strokeWidth, y)
+        context.arc(x, y, strokeWidth, 0, 2 * Math.PI, false)
+      })
+      context.setAttr('strokeStyle', stroke)
+      context.setAttr('lineWidth', strokeWidth)
+      context.stroke()
+    })
+  }
 
   return (
     <div>
       <Stage 
-        width={image_size[0] * (scale*zoom)}
-        height={image_size[1] * (scale*zoom)}
-        onMouseDown={checkDeselect}
+        width={stageWidth}
+        height={stageHeight}
+        x={stagePos.x}
+        y={stagePos.y}
+        draggable={true}
+        dragDistance={3}
+        dragBoundFunc={(pos) => clampPos(pos)}
+        onDragMove={(e) => {
+          if (e.target === e.target.getStage()) {
+            setStagePos({ x: e.target.x(), y: e.target.y() })
+          }
+        }}
+        onWheel={handleWheel}
+        onTouchMove={handleTouchMove}
+        onTouchEnd={() => { pinchDistance.current = null }}
+        // Dragging the stage pans it, so points are added on click instead
+        // of on mouse down
+        onClick={handlePointer}
+        onTap={handlePointer}
       >
-        <Layer>
-          <Image image={image} scaleX={(scale*zoom)} scaleY={(scale*zoom)} />
+        {tiles && view ?
+          <TileLayer tiles={tiles} baseUrl={baseUrl} view={view} screenScale={screenScale} /> :
+          <Layer>
+            <Image image={image} width={image_size[0] * screenScale} height={image_size[1] * screenScale} />
+          </Layer>
+        }
+        <Layer listening={false}>
+          <Shape sceneFunc={drawPoints} />
         </Layer>
         <Layer>
-          {pointsInfo.map((point, i) => {
-            return (
-              <Point
-                key={i}
-                rectProps={point}
-                scale={(scale*zoom)}
-                strokeWidth={strokeWidth}
-                isSelected={mode === 'Transform' && point.id === selectedId}
-                onClick={() => {
-                  if (mode === 'Transform') {
-                    setSelectedId(point.id);
-                    const points = pointsInfo.slice();
-                    const lastIndex = points.length - 1;
-                    const lastItem = points[lastIndex];
-                    points[lastIndex] = points[i];
-                    points[i] = lastItem;
-                    setPointsInfo(points);
-                    setLabel(point.label)
-                  } else if (mode === 'Del') {
-                    const points = pointsInfo.slice();
-                    setPointsInfo(points.filter((element) => element.id !== point.id));
-                  }
-                }}
-                onChange={(newAttrs: any) => {
-                  const points = pointsInfo.slice();
-                  points[i] = newAttrs;
-                  setPointsInfo(points);
-                }}
-              />
-            );
-          })}
+          {selectedPoint &&
+            <Point
+              key={selectedPoint.id}
+              rectProps={selectedPoint}
+              scale={screenScale}
+              strokeWidth={strokeWidth}
+              isSelected={mode === 'Transform'}
+              onClick={onSelectedClick}
+              onChange={onSelectedChange}
+            />
+          }
         </Layer>
       </Stage>
     </div>
@@ -9,28 +9,58 @@ import { ChakraProvider, Box, Spacer, HStack, Center } from '@chakra-ui/react'
 import useImage from 'use-image';
 import ThemeSwitcher from './ThemeSwitcher'
 import PointCanvas from "./PointCanvas";
+import type { TileSet, TileView } from "./TileLayer";
+import { initialModel, pointsReducer } from "./pointsModel";
 
 export interface PythonArgs {
   image_url: string,
-  image_size: number[],
+  image_size: number[],       // Space of the point coordinates
+  display_size: number[],     // Size of the image at image_url
+  viewport_known: boolean,    // Whether Python sized the image to the viewport
+  tiles: TileSet | null,      // Tile pyramid drawn instead of image_url
   label_list: string[],
-  points_info: any[],
+  points_info: any[] | null,  // Only sent when the canvas needs a snapshot
+  snapshot_version: number,   // Last server op included in points_info
+  server_ops: any[],          // Ops pushed by Python, with their version
+  ack: { mount_id: string | null, seq: number },  // Last client op applied
+  id_block: { mount_id: string | null, first: number, end: number } | null,  // Ids reserved for new points
   color_map: any,
   point_width: number,
   use_space: boolean,
+  sync_interval_ms: number,  // Max time an op waits before being sent
+  sync_every_n_ops: number,  // Number of unsent ops that forces a send
   mode: string,   // <-- Added "mode" to the Python arguments
   label: string,  // <-- Added "label" to the Python arguments
-  zoom: number
+  zoom: number    // Initial zoom; the canvas zooms on its own afterwards
 }
+
+// Edit made on the canvas, in canvas terms
+export interface PointOp {
+  op: 'add' | 'move' | 'delete' | 'relabel',
+  id: string,
+  x?: number,
+  y?: number,
+  label?: string
+}
+
 const PointDet = ({ args, theme }: ComponentProps) => {
   const {
     image_url,
     image_size,
+    display_size,
+    viewport_known,
+    tiles,
     label_list,
     points_info,
+    snapshot_version,
+    server_ops,
+    ack,
+    id_block,
     color_map,
     point_width,
     use_space,
+    sync_interval_ms,
+    sync_every_n_ops,
     mode,  // <-- Extract "mode" from the args
     label,  // <-- Extract "label" from the args
     zoom
@@ -38,20 +68,230 @@ const PointDet = ({ args, theme }: ComponentProps) => {
 
   const params = new URLSearchParams(window.location.search);
   const baseUrl = params.get('streamlitUrl')
-  const [image] = useImage(baseUrl + image_url)
-  const [pointsInfo, setPointsInfo] = React.useState(
-    points_info.map((p, i) => {
-      return {
-        x: p.point[0],
-        y: p.point[1],
-        label: p.label,
-        stroke: color_map[p.label],
-        id: 'point-' + i
+  // Zoom of the canvas, changed by wheel and pinch without reruns
+  const [viewZoom, setViewZoom] = useState(zoom)
+  const viewZoomRef = React.useRef(viewZoom)
+  viewZoomRef.current = viewZoom
+  useEffect(() => {
+    setViewZoom(zoom)
+  }, [zoom])
+
+  // The image is only loaded once Python knows the viewport to size it to
+  const [image] = useImage(viewport_known ? baseUrl + image_url : '')
+
+  const toPoint = (p: any, i: number) => {
+    return {
+      x: p.point[0],
+      y: p.point[1],
+      label: p.label,
+      stroke: color_map[p.label],
+      id: p.id != null ? String(p.id) : 'point-' + i
+    }
+  }
+  const [model, dispatch] = React.useReducer(
+    pointsReducer, points_info ? points_info.map(toPoint) : null, initialModel
+  );
+  // Read by the timers and listeners, which outlive the render they were
+  // created in
+  const loaded = React.useRef(model.points !== null)
+  loaded.current = model.points !== null
+
+  // Delta protocol state: ops are numbered per mount of the canvas and kept
+  // until Python acknowledges them
+  const mountId = React.useRef(Math.random().toString(36).slice(2))
+  const seq = React.useRef(0)
+  const pendingOps = React.useRef<any[]>([])
+  const serverVersion = React.useRef(points_info ? snapshot_version : 0)
+  // Snapshot requests are numbered, so Python answers each one once
+  const snapshotRequest = React.useRef(0)
+
+  // New points get ids above every id known so far (those of the snapshot
+  // and of the ops pushed by Python), so they never collide with the ids
+  // stored on the Python side and stay small integers
+  const maxId = (points: any[], start: number) => {
+    return points.reduce((max, p) => Math.max(max, Number(p.id) || 0), start)
+  }
+  const lastId = React.useRef(points_info ? maxId(points_info, 0) : 0);
+  const trackIds = (points: any[]) => {
+    lastId.current = maxId(points, lastId.current)
+  }
+
+  // With a block of ids reserved by Python for this canvas, new points take
+  // the next id of the block, which no other session mints, and the next
+  // block is asked for when a quarter of the current one is left. Blocks
+  // reserved for another mount of the canvas are not used
+  const ownBlock = (block: any) => {
+    return block && (block.mount_id === null || block.mount_id === mountId.current) ? block : null
+  }
+  const firstBlock = ownBlock(id_block)
+  const idBlock = React.useRef(firstBlock ? { next: firstBlock.first, first: firstBlock.first, end: firstBlock.end, requested: false } : null)
+  const idRequest = React.useRef(0)
+  useEffect(() => {
+    const block = ownBlock(id_block)
+    if (block && (idBlock.current === null || idBlock.current.first !== block.first)) {
+      idBlock.current = { next: block.first, first: block.first, end: block.end, requested: false }
+    }
+  }, [id_block?.mount_id, id_block?.first])
+
+  const newPointId = React.useCallback(() => {
+    const block = idBlock.current
+    let id = lastId.current + 1
+    if (block !== null) {
+      if (block.next < block.end) {
+        // Otherwise the next block is late, and the ids follow the known ones
+        id = block.next
+        block.next += 1
+      }
+      if (!block.requested && (block.end - block.next) * 4 <= block.end - block.first) {
+        block.requested = true
+        idRequest.current += 1
+      }
+    }
+    lastId.current = Math.max(lastId.current, id)
+    return id.toString()
+  }, [])
+
+  // Counts the polls for tiles, so each one is a new component value
+  const polls = React.useRef(0)
+
+  const sendOps = (needSnapshot: boolean = false) => {
+    if (needSnapshot) {
+      snapshotRequest.current += 1
+    }
+    Streamlit.setComponentValue({
+      mount_id: mountId.current,
+      seq: seq.current,
+      server_version: serverVersion.current,
+      need_snapshot: needSnapshot,
+      snapshot_request: snapshotRequest.current,
+      id_request: idRequest.current,
+      ops: pendingOps.current,
+      viewport: { width: window.innerWidth, pixel_ratio: window.devicePixelRatio || 1, zoom: viewZoomRef.current },
+      view: tileView.current,
+      poll: polls.current
+    })
+  }
+
+  // While the tile pyramid is built, Python is asked again every second
+  // for the levels written since
+  const pending = tiles != null && tiles.pending
+  useEffect(() => {
+    if (!pending) {
+      return
+    }
+    const timer = window.setInterval(() => {
+      polls.current += 1
+      sendOps(!loaded.current)
+    }, 1000)
+    return () => window.clearInterval(timer)
+  }, [pending])
+
+  // The tiles in view are requested once panning or zooming stops
+  const tileView = React.useRef<TileView | null>(null)
+  const viewTimer = React.useRef<number | null>(null)
+  const onViewChange = (view: TileView) => {
+    tileView.current = view
+    if (viewTimer.current !== null) {
+      window.clearTimeout(viewTimer.current)
+    }
+    viewTimer.current = window.setTimeout(() => {
+      viewTimer.current = null
+      sendOps(!loaded.current)
+    }, 200)
+  }
+
+  // Ops are coalesced and sent in batches, each send being a Streamlit rerun
+  const unsentOps = React.useRef(0)
+  const flushTimer = React.useRef<number | null>(null)
+  const flushOps = () => {
+    if (flushTimer.current !== null) {
+      window.clearTimeout(flushTimer.current)
+      flushTimer.current = null
+    }
+    if (unsentOps.current > 0) {
+      unsentOps.current = 0
+      sendOps()
+    }
+  }
+
+  const queueOps = (ops: PointOp[]) => {
+    ops.forEach((op) => {
+      seq.current += 1
+      const wireOp: any = { seq: seq.current, op: op.op, id: Number(op.id) }
+      if (op.x !== undefined && op.y !== undefined) {
+        wireOp.point = [op.x, op.y]
       }
+      if (op.label !== undefined) {
+        wireOp.label_id = label_list.indexOf(op.label)
+      }
+      pendingOps.current.push(wireOp)
     })
-  );
+    unsentOps.current += ops.length
 
-  const [selectedId, setSelectedId] = React.useState<string | null>(null);
+    if (unsentOps.current >= Math.max(sync_every_n_ops, 1) || !(sync_interval_ms > 0)) {
+      flushOps()
+    } else if (flushTimer.current === null) {
+      flushTimer.current = window.setTimeout(flushOps, sync_interval_ms)
+    }
+  }
+  // Stable across renders, so the canvas callbacks built on it are too
+  const queueOpsRef = React.useRef(queueOps)
+  queueOpsRef.current = queueOps
+  const pushOps = React.useCallback((ops: PointOp[]) => queueOpsRef.current(ops), [])
+
+  // Send the batched ops before the user leaves the canvas
+  useEffect(() => {
+    const handleVisibility = () => {
+      if (document.visibilityState === 'hidden') {
+        flushOps()
+      }
+    }
+    window.addEventListener('blur', flushOps)
+    window.addEventListener('pagehide', flushOps)
+    document.addEventListener('mouseleave', flushOps)
+    document.addEventListener('visibilitychange', handleVisibility)
+    return () => {
+      window.removeEventListener('blur', flushOps)
+      window.removeEventListener('pagehide', flushOps)
+      document.removeEventListener('mouseleave', flushOps)
+      document.removeEventListener('visibilitychange', handleVisibility)
+    }
+  }, [])
+
+  // Load the snapshot, or ask for one after a remount
+  useEffect(() => {
+    if (model.points !== null) {
+      return
+    }
+    if (points_info) {
+      trackIds(points_info)
+      serverVersion.current = snapshot_version
+      dispatch({ type: 'snapshot', points: points_info.map(toPoint) })
+    } else {
+      sendOps(true)
+    }
+  }, [points_info])
+
+  // Drop the ops Python has applied
+  useEffect(() => {
+    if (ack && ack.mount_id === mountId.current) {
+      pendingOps.current = pendingOps.current.filter((op) => op.seq > ack.seq)
+    }
+  }, [ack?.mount_id, ack?.seq])
+
+  // Apply the ops pushed by Python since the last one seen
+  useEffect(() => {
+    if (model.points === null) {
+      return
+    }
+    const ops = server_ops.filter((op) => op.version > serverVersion.current)
+    if (ops.length === 0) {
+      return
+    }
+    serverVersion.current = ops.reduce((max, op) => Math.max(max, op.version), serverVersion.current)
+    trackIds(ops)
+    dispatch({ type: 'server_ops', ops: ops, label_list: label_list, color_map: color_map })
+  }, [server_ops, model.points === null])
 
   const [scale, setScale] = useState(1.0)
   useEffect(() => {
@@ -62,47 +302,60 @@ const PointDet = ({ args, theme }: ComponentProps) => {
     }
     window.addEventListener('resize', resizeCanvas);
     resizeCanvas()
+    return () => {
+      window.removeEventListener('resize', resizeCanvas);
+    };
   }, [image_size])
 
+  // Report the viewport when the display image is not sized to it yet, or
+  // when it is too small for the canvas on screen once zooming stops
+  const resolutionTimer = React.useRef<number | null>(null)
+  useEffect(() => {
+    const checkResolution = () => {
+      const shown = image_size[0] * Math.min(window.innerWidth / image_size[0], 1.0) * viewZoom
+      const needed = Math.min(shown * (window.devicePixelRatio || 1), image_size[0])
+      if (!viewport_known || display_size[0] < needed - 1) {
+        sendOps(!loaded.current)
+      }
+    }
+    const scheduleCheck = () => {
+      if (resolutionTimer.current !== null) {
+        window.clearTimeout(resolutionTimer.current)
+      }
+      resolutionTimer.current = window.setTimeout(() => {
+        resolutionTimer.current = null
+        checkResolution()
+      }, viewport_known ? 300 : 0)
+    }
+    window.addEventListener('resize', scheduleCheck);
+    scheduleCheck()
+    return () => {
+      window.removeEventListener('resize', scheduleCheck);
+    };
+  }, [viewport_known, display_size[0], image_size[0], viewZoom])
+
   useEffect(() => {
     const handleKeyPress = (event: KeyboardEvent) => {
-      if (use_space && event.key === ' ') { 
-        const currentPointsValue = pointsInfo.map((point, i) => {
-          return {
-            point: [point.x, point.y],
-            label_id: label_list.indexOf(point.label),
-            label: point.label
-          }
-        })
-        Streamlit.setComponentValue(currentPointsValue)
+      // Send the batched ops, and re-send those not acknowledged yet
+      if (use_space && event.key === ' ') {
+        unsentOps.current = 0
+        flushOps()
+        sendOps()
       }
     };
     window.addEventListener('keydown', handleKeyPress);
     return () => {
       window.removeEventListener('keydown', handleKeyPress);
     };
-  }, [pointsInfo]); 
-
-  // This effect runs only when pointsInfo changes
-  useEffect(() => {
-    // Only set the component value when pointsInfo changes
-    const currentPointsValue = pointsInfo.map((point, i) => {
-      return {
-        point: [point.x, point.y],
-        label_id: label_list.indexOf(point.label),
-        label: point.label
-      }
-    })
-    Streamlit.setComponentValue(currentPointsValue)
-  }, [pointsInfo]); // Triggered when pointsInfo changes
+  }, [use_space]);
 
   return (
     <ChakraProvider>
       <ThemeSwitcher theme={theme}>
         <Center>
           <HStack width="100%" height="100%">
-            <Box 
-              width="100%" 
+            <Box
+              width="100%"
               style={{
                 overflow: 'auto',  // Scrollbars enabled if content overflows
                 maxWidth: '100%',  // Restrict width to avoid unnecessary scroll
@@ -110,21 +363,28 @@ const PointDet = ({ args, theme }: ComponentProps) => {
                 position: 'relative' // Needed for proper overflow control
               }}
             >
-              <PointCanvas
-                pointsInfo={pointsInfo}
-                mode={mode} 
-                selectedId={selectedId}
-                scale={scale}
-                setSelectedId={setSelectedId}
-                setPointsInfo={setPointsInfo}
-                setLabel={() => {}}
-                color_map={color_map}
-                label={label} 
-                image={image}
-                image_size={image_size}
-                strokeWidth={point_width}
-                zoom={zoom}
-              />
+              {model.points !== null &&
+                <PointCanvas
+                  points={model.points}
+                  loads={model.loads}
+                  mode={mode}
+                  selectedId={model.selectedId}
+                  scale={scale}
+                  dispatch={dispatch}
+                  newPointId={newPointId}
+                  pushOps={pushOps}
+                  color_map={color_map}
+                  label={label}
+                  image={image}
+                  image_size={image_size}
+                  strokeWidth={point_width}
+                  zoom={viewZoom}
+                  setZoom={setViewZoom}
+                  tiles={tiles ?? null}
+                  baseUrl={baseUrl}
+                  onViewChange={onViewChange}
+                />
+              }
             </Box>
           </HStack>
         </Center>
@@ -133,4 +393,4 @@ const PointDet = ({ args, theme }: ComponentProps) => {
   )
 }
 
-export default withStreamlitConnection(PointDet)
\ No newline at end of file
+export default withStreamlitConnection(PointDet)
@@ -0,0 +1,85 @@
+import React from "react"
+import { Layer, Image } from 'react-konva';
+import useImage from 'use-image';
+
+// Tile pyramid sent by Python: URLs of the registered tiles by "level/col/row"
+export interface TileSet {
+  tile_size: number,
+  scale: number,       // Full-resolution pixels per point coordinate
+  levels: number[][],  // Size of each level, level 0 being the full image
+  urls: { [tile: string]: string },
+  pending: boolean     // Whether some levels are still being built
+}
+
+// Visible part of the image, in full-resolution pixels, and the level that
+// matches the screen resolution
+export interface TileView {
+  level: number,
+  x0: number,
+  y0: number,
+  x1: number,
+  y1: number
+}
+
+export const viewLevel = (tiles: TileSet, screenScale: number) => {
+  // Screen pixels per full-resolution pixel
+  const density = screenScale * (window.devicePixelRatio || 1) / tiles.scale
+  const level = Math.floor(Math.log2(1 / density))
+  return Math.min(Math.max(level, 0), tiles.levels.length - 1)
+}
+
+interface TileProps {
+  url: string,
+  x: number,
+  y: number,
+  width: number,
+  height: number
+}
+
+const Tile = ({ url, x, y, width, height }: TileProps) => {
+  const [image] = useImage(url)
+  return <Image image={image} x={x} y={y} width={width} height={height} listening={false} />
+}
+
+export interface TileLayerProps {
+  tiles: TileSet,
+  baseUrl: string | null,
+  view: TileView,
+  screenScale: number  // Screen pixels per point coordinate
+}
+
+// Draws the tiles of the coarsest level sent, then those of the view level
+// over them; tiles outside the view are not drawn
+const TileLayer = ({ tiles, baseUrl, view, screenScale }: TileLayerProps) => {
+  const nodes = Object.keys(tiles.urls)
+    .map((tile) => tile.split('/').map(Number))
+    .filter(([level, col, row]) => {
+      const span = tiles.tile_size * 2 ** level
+      return col * span < view.x1 && (col + 1) * span > view.x0
+        && row * span < view.y1 && (row + 1) * span > view.y0
+    })
+    .sort((a, b) => b[0] - a[0])
+    .map(([level, col, row]) => {
+      const [levelWidth, levelHeight] = tiles.levels[level]
+      const span = tiles.tile_size * 2 ** level
+      // Edge tiles are cut to the level size
+      const width = Math.min(tiles.tile_size, levelWidth - col * tiles.tile_size) * 2 ** level
+      const height = Math.min(tiles.tile_size, levelHeight - row * tiles.tile_size) * 2 ** level
+      const factor = screenScale / tiles.scale
+      const tile = `${level}/${col}/${row}`
+      return (
+        <Tile
+          key={tile}
+          url={baseUrl + tiles.urls[tile]}
+          x={col * span * factor}
+          y={row * span * factor}
+          width={width * factor}
+          height={height * factor}
+        />
+      )
+    })
+
+  return <Layer listening={false}>{nodes}</Layer>
+}
+
+export default TileLayer
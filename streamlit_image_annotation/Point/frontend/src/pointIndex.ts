@@ -0,0 +1,126 @@
+// Points held by a leaf before it is split, and depth below which leaves are
+// not split any more (many points on the same spot)
+const NODE_CAPACITY = 16
+const MAX_DEPTH = 18
+
+interface QuadNode {
+  x0: number,
+  y0: number,
+  x1: number,
+  y1: number,
+  depth: number,
+  points: any[],
+  children: QuadNode[] | null
+}
+
+const newNode = (x0: number, y0: number, x1: number, y1: number, depth: number): QuadNode => {
+  return { x0, y0, x1, y1, depth, points: [], children: null }
+}
+
+// Squared distance from (x, y) to the box of a node
+const boxDistance = (node: QuadNode, x: number, y: number) => {
+  const dx = Math.max(node.x0 - x, 0, x - node.x1)
+  const dy = Math.max(node.y0 - y, 0, y - node.y1)
+  return dx * dx + dy * dy
+}
+
+// Quadtree over the point coordinates, updated point by point as they are
+// added, moved and deleted, to find the point under the pointer in
+// O(log N) without one hit canvas per point
+export class PointQuadtree {
+  root: QuadNode
+  outside: any[]  // Points out of the bounds of the tree, checked one by one
+
+  constructor(width: number, height: number, points: any[] = []) {
+    this.root = newNode(0, 0, Math.max(width, 1), Math.max(height, 1), 0)
+    this.outside = []
+    points.forEach((point) => this.insert(point))
+  }
+
+  contains(node: QuadNode, x: number, y: number) {
+    return x >= node.x0 && x <= node.x1 && y >= node.y0 && y <= node.y1
+  }
+
+  // Leaf whose box holds (x, y)
+  leaf(x: number, y: number) {
+    let node = this.root
+    while (node.children !== null) {
+      const midX = (node.x0 + node.x1) / 2
+      const midY = (node.y0 + node.y1) / 2
+      node = node.children[(x < midX ? 0 : 1) + (y < midY ? 0 : 2)]
+    }
+    return node
+  }
+
+  split(node: QuadNode) {
+    const midX = (node.x0 + node.x1) / 2
+    const midY = (node.y0 + node.y1) / 2
+    node.children = [
+      newNode(node.x0, node.y0, midX, midY, node.depth + 1),
+      newNode(midX, node.y0, node.x1, midY, node.depth + 1),
+      newNode(node.x0, midY, midX, node.y1, node.depth + 1),
+      newNode(midX, midY, node.x1, node.y1, node.depth + 1)
+    ]
+    const points = node.points
+    node.points = []
+    points.forEach((point) => this.leaf(point.x, point.y).points.push(point))
+  }
+
+  insert(point: any) {
+    if (!this.contains(this.root, point.x, point.y)) {
+      this.outside.push(point)
+      return
+    }
+    const node = this.leaf(point.x, point.y)
+    node.points.push(point)
+    if (node.points.length > NODE_CAPACITY && node.depth < MAX_DEPTH) {
+      this.split(node)
+    }
+  }
+
+  // Removes a point, looked up by id at the coordinates it was inserted with
+  remove(point: any) {
+    const points = this.contains(this.root, point.x, point.y) ? this.leaf(point.x, point.y).points : this.outside
+    const i = points.findIndex((p) => p.id === point.id)
+    if (i >= 0) {
+      points.splice(i, 1)
+    }
+  }
+
+  move(from: any, to: any) {
+    this.remove(from)
+    this.insert(to)
+  }
+
+  // Nearest point within `radius` of (x, y), or null. Nodes are visited
+  // nearest first and pruned once they are farther than the best point
+  nearest(x: number, y: number, radius: number) {
+    let best: any = null
+    let bestDistance = radius * radius
+
+    const check = (point: any) => {
+      const distance = (point.x - x) ** 2 + (point.y - y) ** 2
+      if (distance <= bestDistance) {
+        best = point
+        bestDistance = distance
+      }
+    }
+    this.outside.forEach(check)
+
+    const visit = (node: QuadNode) => {
+      if (boxDistance(node, x, y) > bestDistance) {
+        return
+      }
+      if (node.children === null) {
+        node.points.forEach(check)
+        return
+      }
+      node.children
+        .map((child) => [boxDistance(child, x, y), child] as [number, QuadNode])
+        .sort((a, b) => a[0] - b[0])
+        .forEach(([, child]) => visit(child))
+    }
+    visit(this.root)
+    return best
+  }
+}
@@ -0,0 +1,80 @@
+// Point as drawn on the canvas, in the coordinates of image_size
+export interface PointItem {
+  x: number,
+  y: number,
+  label: string,
+  stroke: string,
+  id: string
+}
+
+// Points by id, in drawing order, and the selected point. `loads` counts
+// the snapshots and server ops applied, the changes not made on the canvas
+export interface PointsModel {
+  points: Map<string, PointItem> | null,
+  selectedId: string | null,
+  loads: number
+}
+
+export type PointsAction =
+  | { type: 'snapshot', points: PointItem[] }
+  | { type: 'add', point: PointItem }
+  | { type: 'move', id: string, x: number, y: number }
+  | { type: 'delete', id: string }
+  | { type: 'select', id: string | null }
+  | { type: 'server_ops', ops: any[], label_list: string[], color_map: any }
+
+export const initialModel = (points: PointItem[] | null): PointsModel => {
+  return {
+    points: points ? new Map(points.map((point) => [point.id, point])) : null,
+    selectedId: null,
+    loads: 0
+  }
+}
+
+// Each action copies the map once and touches only the points it names
+export const pointsReducer = (model: PointsModel, action: PointsAction): PointsModel => {
+  if (action.type === 'snapshot') {
+    return { ...initialModel(action.points), selectedId: model.selectedId, loads: model.loads + 1 }
+  }
+  if (action.type === 'select') {
+    return model.selectedId === action.id ? model : { ...model, selectedId: action.id }
+  }
+  if (model.points === null) {
+    return model
+  }
+
+  const points = new Map(model.points)
+  switch (action.type) {
+    case 'add':
+      points.set(action.point.id, action.point)
+      return { ...model, points }
+    case 'move': {
+      const point = points.get(action.id)
+      if (point === undefined) {
+        return model
+      }
+      points.set(action.id, { ...point, x: action.x, y: action.y })
+      return { ...model, points }
+    }
+    case 'delete':
+      points.delete(action.id)
+      return { ...model, points, selectedId: model.selectedId === action.id ? null : model.selectedId }
+    case 'server_ops':
+      action.ops.forEach((op) => {
+        const id = String(op.id)
+        const point = points.get(id)
+        const label = op.label_id !== undefined ? action.label_list[op.label_id] : undefined
+        if (op.op === 'add' && point === undefined) {
+          points.set(id, { x: op.point[0], y: op.point[1], label: label as string, stroke: action.color_map[label as string], id: id })
+        } else if (op.op === 'move' && point !== undefined) {
+          points.set(id, { ...point, x: op.point[0], y: op.point[1] })
+        } else if (op.op === 'relabel' && point !== undefined) {
+          points.set(id, { ...point, label: label as string, stroke: action.color_map[label as string] })
+        } else if (op.op === 'delete') {
+          points.delete(id)
+        }
+      })
+      return { ...model, points, loads: model.loads + 1 }
+  }
+  return model
+}
@@ -0,0 +1,209 @@
+import io
+import math
+import os
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+from hashlib import md5
+
+from PIL import Image
+
+# Formats every browser decodes, served as they are stored when possible
+BROWSER_FORMATS = {"JPEG", "PNG", "WEBP", "GIF"}
+BROWSER_MODES = {"RGB", "RGBA", "L", "LA", "P"}
+
+# Quality of the JPEG derivatives of downsampled or non-browser images
+DERIVATIVE_QUALITY = 90
+
+# Whole-slide images are far above the decompression bomb limit of PIL
+# (about 89 million pixels), which would refuse them. Images are only opened
+# from the data folders of the app, so the limit is raised to this many
+# pixels: PIL warns above it, and refuses images of twice as many pixels
+MAX_IMAGE_PIXELS = 2**31
+Image.MAX_IMAGE_PIXELS = MAX_IMAGE_PIXELS
+
+
+@dataclass
+class DisplayImage:
+    """
+    Image shown by a pointdet canvas.
+
+    Attributes:
+        original_size (tuple): Size of the image file.
+        size (tuple): Size of the displayed thumbnail.
+        image (PIL.Image.Image): The thumbnail (the file itself, not
+            decoded, when it is served as stored).
+        digest (str): Hash of `data`.
+        data (bytes): The file bytes, or a JPEG/PNG derivative of the
+            thumbnail, sent to the browser.
+        mimetype (str): Mimetype of `data`.
+        url (str): Media URL the image was last registered at.
+        decoded (bool): Whether `image` holds decoded pixels.
+    """
+    original_size: tuple
+    size: tuple
+    image: Image.Image
+    digest: str
+    data: bytes
+    mimetype: str = "image/png"
+    url: str = None
+    decoded: bool = True
+
+    @property
+    def nbytes(self):
+        decoded = len(self.image.getbands()) * self.size[0] * self.size[1] if self.decoded else 0
+        return len(self.data) + decoded
+
+
+class ImageCache:
+    """
+    Process-wide LRU cache of the images shown by pointdet, so that reruns
+    neither decode, resize, hash nor encode the image file again.
+
+    Entries are keyed by the path, modification time and size of the file and
+    by the requested display size, and evicted once the decoded and encoded
+    images held exceed `max_bytes`.
+
+    Args:
+        max_bytes (int, optional): Memory budget of the cache.
+    """
+
+    def __init__(self, max_bytes=256 * 2**20):
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._sizes = {}  # File key -> size read from the image header
+        self._lock = threading.Lock()
+
+    def _load(self, image_path, width, height):
+        with open(image_path, "rb") as image_file:
+            raw = image_file.read()
+        image = Image.open(io.BytesIO(raw))
+        original_size = image.size
+        source_format = image.format
+
+        # Files that fit and that the browser shows as PIL reads them (no
+        # EXIF rotation) are sent untouched, without decoding them
+        fits = image.width <= width and image.height <= height
+        upright = image.getexif().get(0x0112, 1) == 1
+        if fits and upright and source_format in BROWSER_FORMATS and image.mode in BROWSER_MODES:
+            data, mimetype, decoded = raw, Image.MIME[source_format], False
+        else:
+            image.thumbnail(size=(width, height))
+            data, mimetype = _encode_derivative(image)
+            decoded = True
+
+        return DisplayImage(
+            original_size=original_size,
+            size=image.size,
+            image=image,
+            digest=md5(data).hexdigest(),
+            data=data,
+            mimetype=mimetype,
+            decoded=decoded,
+        )
+
+    def _file_key(self, image_path):
+        stat = os.stat(image_path)
+        return (os.path.abspath(image_path), stat.st_mtime_ns, stat.st_size)
+
+    def image_size(self, image_path):
+        """
+        Returns the (width, height) of an image file, read from its header.
+        """
+        key = self._file_key(image_path)
+        with self._lock:
+            size = self._sizes.get(key)
+        if size is None:
+            with Image.open(image_path) as image:
+                size = image.size
+            with self._lock:
+                self._sizes[key] = size
+        return size
+
+    def get(self, image_path, width, height):
+        """
+        Returns the DisplayImage of an image file thumbnailed to fit in
+        (width, height).
+        """
+        key = self._file_key(image_path) + (width, height)
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry
+            self.misses += 1
+
+        entry = self._load(image_path, width, height)
+
+        with self._lock:
+            if key not in self._entries:
+                self._entries[key] = entry
+                self._bytes += entry.nbytes
+            # Keep at least the newest entry, even if it exceeds the budget
+            while self._bytes > self.max_bytes and len(self._entries) > 1:
+                _, evicted = self._entries.popitem(last=False)
+                self._bytes -= evicted.nbytes
+                self.evictions += 1
+            return self._entries.get(key, entry)
+
+    def stats(self):
+        """
+        Returns the hit/miss counters and the memory held by the cache.
+        """
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+            }
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._sizes.clear()
+            self._bytes = 0
+
+
+def fit_size(size, width, height):
+    """
+    Returns the size `Image.thumbnail` gives an image of `size` fitted in
+    (width, height), without decoding it.
+    """
+    x, y = math.floor(width), math.floor(height)
+    if x >= size[0] and y >= size[1]:
+        return tuple(size)
+
+    def round_aspect(number, key):
+        return max(min(math.floor(number), math.ceil(number), key=key), 1)
+
+    aspect = size[0] / size[1]
+    if x / y >= aspect:
+        x = round_aspect(y * aspect, key=lambda n: abs(aspect - n / y))
+    else:
+        y = round_aspect(x / aspect, key=lambda n: 0 if n == 0 else abs(aspect - x / n))
+    return x, y
+
+
+def _encode_derivative(image):
+    """
+    Returns the bytes and mimetype of the display derivative of an image:
+    PNG if it has transparency, JPEG otherwise.
+    """
+    buffer = io.BytesIO()
+    if image.mode in ("RGBA", "LA") or "transparency" in image.info:
+        image.save(buffer, format="PNG")
+        return buffer.getvalue(), "image/png"
+    image.convert("RGB").save(buffer, format="JPEG", quality=DERIVATIVE_QUALITY)
+    return buffer.getvalue(), "image/jpeg"
+
+
+image_cache = ImageCache()
@@ -0,0 +1,255 @@
+import json
+import math
+import os
+import shutil
+import threading
+from functools import lru_cache
+from hashlib import md5
+from pathlib import Path
+
+from PIL import Image
+
+# Side of the square tiles, in pixels of their level
+TILE_SIZE = 256
+
+# JPEG quality of the tiles
+TILE_QUALITY = 85
+
+# The coarsest level with at most this many tiles is always sent, as the
+# backdrop shown while the tiles of the current level load
+OVERVIEW_TILES = 16
+
+# Images from this many pixels on are tiled; smaller ones are served whole
+TILE_MIN_PIXELS = 4096 * 4096
+
+# Tiles kept in memory, so those in view are not read again on every rerun
+TILE_CACHE_SIZE = 512
+
+
+class TilePyramid:
+    """
+    Multi-resolution pyramid of JPEG tiles of an image, cached on disk so
+    that the canvas only fetches the tiles it shows.
+
+    Level 0 is the image at full resolution and each level halves the one
+    before it, down to a level that fits in a single tile. Tiles are stored
+    as `<cache_dir>/<ab>/<cd>/<key>/<level>/<col>_<row>.jpg`, where the key
+    (starting with `abcd`) depends on the path, modification time and size
+    of the image file.
+
+    Args:
+        image_path (str): Path of the image file.
+        cache_dir (str): Directory where the pyramids are stored.
+    """
+
+    def __init__(self, image_path, cache_dir):
+        self.image_path = os.path.abspath(image_path)
+        self.key = _pyramid_key(self.image_path)
+        self.path = Path(cache_dir) / self.key[:2] / self.key[2:4] / self.key
+        self.levels = None  # (width, height) of each level
+        self.ready = set()  # Levels whose tiles are all written
+        self.error = None   # Exception raised by the build, if it failed
+        self._root = self.path  # Directory the tiles are read from
+
+    @property
+    def index_path(self):
+        return self.path / "pyramid.json"
+
+    @property
+    def complete(self):
+        return self.levels is not None and len(self.ready) == len(self.levels)
+
+    def load(self):
+        """
+        Loads the levels of a pyramid already on disk. Returns False if it
+        has not been built.
+        """
+        try:
+            with open(self.index_path, "r", encoding="utf-8") as index_file:
+                self.levels = [tuple(size) for size in json.load(index_file)["levels"]]
+        except FileNotFoundError:
+            return False
+        self.ready = set(range(len(self.levels)))
+        return True
+
+    def start(self):
+        """
+        Starts building the pyramid in a background thread. The levels are
+        known at once, from the size in the header of the image file.
+        """
+        with Image.open(self.image_path) as image:
+            self.levels = _level_sizes(image.size)
+        threading.Thread(target=self._build_in_background, daemon=True).start()
+
+    def _build_in_background(self):
+        try:
+            self.build()
+        except Exception as e:
+            self.error = e
+
+    def build(self):
+        """
+        Writes every tile of the pyramid. The pyramid is built in a temporary
+        directory and renamed when complete, so a half-built pyramid is never
+        loaded; meanwhile the levels already written are served from there.
+
+        The coarse levels come first, from the image decoded at reduced scale
+        (JPEG files are decoded at 1/2 to 1/8 scale in draft mode), so the
+        overview shows quickly. The finer levels need the image decoded at
+        full resolution, as PIL has no region reader for most formats; they
+        are written from the coarsest to the finest.
+        """
+        staging = self.path.with_name(f"{self.key}.{os.getpid()}.{threading.get_ident()}.tmp")
+        shutil.rmtree(staging, ignore_errors=True)
+        self._root = staging
+
+        overview = self.overview_level
+        images = [self._decode(overview)]
+        while images[-1].width > TILE_SIZE or images[-1].height > TILE_SIZE:
+            images.append(images[-1].reduce(2))
+        self._write_levels(staging, overview, images)
+
+        if overview > 0:
+            images = [self._decode(0)]
+            while len(images) < overview:
+                images.append(images[-1].reduce(2))
+            self._write_levels(staging, 0, images)
+        del images
+
+        with open(staging / "pyramid.json", "w", encoding="utf-8") as index_file:
+            json.dump({"tile_size": TILE_SIZE, "levels": self.levels}, index_file)
+        try:
+            os.rename(staging, self.path)
+        except OSError:
+            # Built by another process in the meantime
+            shutil.rmtree(staging, ignore_errors=True)
+        self._root = self.path
+
+    def _decode(self, level):
+        """
+        Decodes the image at the size of a level, as cheaply as its format
+        allows.
+        """
+        width, height = self.levels[level]
+        with Image.open(self.image_path) as source:
+            source.draft("RGB", (width, height))
+            image = source.convert("RGB")
+        # Draft mode stops at 1/8 scale, and other formats decode in full
+        while image.width > width:
+            image = image.reduce(2)
+        if image.size != (width, height):
+            image = image.resize((width, height))
+        return image
+
+    def _write_levels(self, staging, first, images):
+        """
+        Writes the tiles of the levels from `first` on, given their images,
+        the coarsest level first.
+        """
+        for level in reversed(range(first, first + len(images))):
+            image = images[level - first]
+            level_dir = staging / str(level)
+            level_dir.mkdir(parents=True)
+            for row in range(math.ceil(image.height / TILE_SIZE)):
+                for col in range(math.ceil(image.width / TILE_SIZE)):
+                    box = (col * TILE_SIZE, row * TILE_SIZE, min((col + 1) * TILE_SIZE, image.width), min((row + 1) * TILE_SIZE, image.height))
+                    image.crop(box).save(level_dir / f"{col}_{row}.jpg", format="JPEG", quality=TILE_QUALITY)
+            self.ready.add(level)
+
+    @property
+    def overview_level(self):
+        """
+        Returns the finest level with at most OVERVIEW_TILES tiles.
+        """
+        for level, (width, height) in enumerate(self.levels):
+            if math.ceil(width / TILE_SIZE) * math.ceil(height / TILE_SIZE) <= OVERVIEW_TILES:
+                return level
+        return len(self.levels) - 1
+
+    def tiles(self, level, box=None):
+        """
+        Returns the (level, col, row) of the tiles of a level overlapping
+        `box` (x0, y0, x1, y1), in full-resolution pixels, or of all the tiles
+        of the level.
+        """
+        width, height = self.levels[level]
+        cols, rows = math.ceil(width / TILE_SIZE), math.ceil(height / TILE_SIZE)
+        if box is None:
+            col_range, row_range = range(cols), range(rows)
+        else:
+            span = TILE_SIZE * 2**level
+            x0, y0, x1, y1 = box
+            col_range = range(max(int(x0 // span), 0), min(int(math.ceil(x1 / span)), cols))
+            row_range = range(max(int(y0 // span), 0), min(int(math.ceil(y1 / span)), rows))
+        return [(level, col, row) for row in row_range for col in col_range]
+
+    def read_tile(self, level, col, row):
+        root = self._root
+        try:
+            return _read_tile_file(root / str(level) / f"{col}_{row}.jpg")
+        except FileNotFoundError:
+            if root == self.path:
+                raise
+            # The build was renamed to its final directory meanwhile
+            return _read_tile_file(self.path / str(level) / f"{col}_{row}.jpg")
+
+
+def _pyramid_key(image_path):
+    stat = os.stat(image_path)
+    return md5(f"{image_path}:{stat.st_mtime_ns}:{stat.st_size}".encode()).hexdigest()
+
+
+def _level_sizes(size):
+    """
+    Returns the (width, height) of each level of the pyramid of an image of
+    `size`, as `Image.reduce(2)` halves them.
+    """
+    levels = [tuple(size)]
+    while levels[-1][0] > TILE_SIZE or levels[-1][1] > TILE_SIZE:
+        width, height = levels[-1]
+        levels.append(((width + 1) // 2, (height + 1) // 2))
+    return levels
+
+
+@lru_cache(maxsize=TILE_CACHE_SIZE)
+def _read_tile_file(path):
+    # Tiles never change: a rebuilt image gets a pyramid with a new key
+    with open(path, "rb") as tile_file:
+        return tile_file.read()
+
+
+_pyramids = {}
+_pyramids_lock = threading.Lock()
+
+
+def get_pyramid(image_path, cache_dir):
+    """
+    Returns the TilePyramid of an image, and starts building it in the
+    background the first time, so the script never waits for the image to be
+    decoded. Its levels are served as they are written (see `ready`).
+    Sessions asking for the same pyramid share a single build.
+    """
+    pyramid = TilePyramid(image_path, cache_dir)
+    with _pyramids_lock:
+        pyramid = _pyramids.setdefault(pyramid.path, pyramid)
+        if pyramid.levels is None and not pyramid.load():
+            pyramid.path.parent.mkdir(parents=True, exist_ok=True)
+            pyramid.start()
+    return pyramid
+
+
+def prune_pyramids(cache_dir, image_paths):
+    """
+    Deletes the pyramids of `cache_dir` that do not belong to one of the
+    image files of `image_paths` (as they are now). The staging directories
+    of the pyramids being built are left alone.
+    """
+    cache_dir = Path(cache_dir)
+    if not cache_dir.is_dir():
+        return
+    keep = {_pyramid_key(os.path.abspath(path)) for path in image_paths if os.path.isfile(path)}
+    for path in cache_dir.glob("*/*/*"):
+        if path.is_dir() and path.suffix != ".tmp" and path.name not in keep:
+            with _pyramids_lock:
+                _pyramids.pop(path, None)
+            shutil.rmtree(path, ignore_errors=True)
@@ -1,3 +1,3 @@
 IS_RELEASE = True
 
-from .Point import pointdet
\ No newline at end of file
+from .Point import pointdet, push_ops, image_cache, prune_pyramids
\ No newline at end of file
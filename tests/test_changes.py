@@ -0,0 +1,100 @@
+from annotation_core import PointStore, apply_changes, apply_ops, diff_points
+
+LABELS = ["positive", "negative"]
+
+
+def make_store(points):
+    store = PointStore(LABELS)
+    for point_id, x, y, label_id in points:
+        store.add(x, y, label_id, point_id)
+    return store
+
+
+def as_rows(store):
+    return sorted(zip(*(column.tolist() for column in store.columns())))
+
+
+def test_diff_points_by_id():
+    store = make_store([(1, 10, 10, 0), (2, 20, 20, 0), (3, 30, 30, 1)])
+    patch = [
+        {'point': [10.7, 10.2], 'label_id': 1, 'id': 1},
+        {'point': [25, 25], 'label_id': 0, 'id': 2},
+        {'point': [40, 40], 'label_id': 1, 'id': 7},
+    ]
+
+    changes = diff_points(patch, store)
+
+    assert changes.added == [(7, 40, 40, 1)]
+    assert changes.removed == [3]
+    assert changes.moved == [(2, 25, 25)]
+    assert changes.relabeled == [(1, 1)]
+
+
+def test_diff_points_by_position():
+    store = make_store([(1, 10, 10, 0), (2, 20, 20, 0)])
+    patch = [
+        {'point': [10, 10], 'label_id': 1},
+        {'point': [50, 50], 'label_id': 0},
+        {'point': [50.4, 50.9], 'label_id': 0},
+    ]
+
+    changes = diff_points(patch, store)
+
+    assert changes.added == [(None, 50, 50, 0)]
+    assert changes.removed == [2]
+    assert changes.relabeled == [(1, 1)]
+    apply_changes(changes, store)
+    assert [(x, y, label_id) for _, x, y, label_id in as_rows(store)] == [(10, 10, 1), (50, 50, 0)]
+
+
+def test_diff_points_of_identical_patch_is_empty():
+    store = make_store([(1, 10, 10, 0), (2, 20, 20, 1)])
+    patch = store.as_payload()
+
+    assert not diff_points(patch, store)
+
+
+def test_apply_ops_coalesces_batch():
+    store = make_store([(1, 10, 10, 0), (2, 20, 20, 0), (3, 30, 30, 0)])
+    ops = [
+        {'op': 'add', 'id': 4, 'point': [40, 40], 'label_id': 0},
+        {'op': 'move', 'id': 4, 'point': [41, 41]},
+        {'op': 'relabel', 'id': 4, 'label_id': 1},
+        {'op': 'add', 'id': 5, 'point': [50, 50], 'label_id': 0},
+        {'op': 'delete', 'id': 5},
+        {'op': 'move', 'id': 1, 'point': [11, 11]},
+        {'op': 'move', 'id': 1, 'point': [12, 12]},
+        {'op': 'relabel', 'id': 2, 'label_id': 1},
+        {'op': 'move', 'id': 3, 'point': [31, 31]},
+        {'op': 'delete', 'id': 3},
+        {'op': 'delete', 'id': 99},
+    ]
+
+    changes = apply_ops(ops, store)
+
+    assert changes.added == [(4, 41, 41, 1)]
+    assert changes.removed == [3]
+    assert changes.moved == [(1, 12, 12)]
+    assert changes.relabeled == [(2, 1)]
+    assert as_rows(store) == [(1, 12, 12, 0), (2, 20, 20, 1), (4, 41, 41, 1)]
+
+
+def test_apply_ops_replayed_add_updates_point():
+    store = make_store([(1, 10, 10, 0)])
+
+    changes = apply_ops([{'op': 'add', 'id': 1, 'point': [15, 16], 'label_id': 1}], store)
+
+    assert changes.added == []
+    assert changes.moved == [(1, 15, 16)]
+    assert changes.relabeled == [(1, 1)]
+    assert as_rows(store) == [(1, 15, 16, 1)]
+
+
+def test_empty_store_copy_grows():
+    store = PointStore(LABELS, capacity=0).copy()
+
+    store.add(1, 2, 0)
+    store.extend([3, 4, 5], [6, 7, 8], [1, 1, 0])
+
+    assert len(store) == 4
+    assert store.counts_by_label().tolist() == [2, 2]
@@ -0,0 +1,67 @@
+import subprocess
+import sys
+from pathlib import Path
+
+from annotators import ANNOTATORS
+
+ROOT = Path(__file__).parent.parent
+
+# Modules only needed by optional features, imported lazily where used
+LAZY_MODULES = ["matplotlib", "pandas", "cv2"]
+
+# The app and the annotator opened by default may take this many times as
+# long to import as Streamlit alone, the floor every Streamlit app pays.
+# Relative, so the budget holds on slow and loaded machines alike
+BUDGET_RATIO = 3
+
+RUNS = 3
+
+
+def import_times(modules):
+    """
+    Imports `modules` in a fresh interpreter, under `python -X importtime`.
+
+    Returns:
+        tuple: Total import time of the modules in microseconds, and the set
+            of all the modules imported.
+    """
+    code = "; ".join(f"import {module}" for module in modules)
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code],
+        cwd=ROOT, capture_output=True, text=True, check=True
+    )
+
+    total = 0
+    imported = set()
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, name = line.split("|")
+        name = name.strip()
+        imported.add(name)
+        if name in modules:
+            total += int(cumulative)
+    return total, imported
+
+
+def fastest(modules):
+    # The fastest run is the least disturbed by the rest of the machine
+    return min(import_times(modules)[0] for _ in range(RUNS))
+
+
+def app_modules():
+    default_annotator = next(annotator for annotator in ANNOTATORS if annotator.enabled)
+    return ["main", default_annotator.module]
+
+
+def test_lazy_modules_stay_off_the_hot_path():
+    _, imported = import_times(app_modules())
+
+    assert [module for module in LAZY_MODULES if module in imported] == []
+
+
+def test_import_time_within_budget():
+    app_time = fastest(app_modules())
+    streamlit_time = fastest(["streamlit"])
+
+    assert app_time <= BUDGET_RATIO * streamlit_time
@@ -0,0 +1,120 @@
+import os
+
+from annotation_core import AnnotationJournal, ChangeSet, PointStore, apply_changes, close_journal, diff_points, open_journal
+
+LABELS = ["positive", "negative"]
+
+
+def load(csv_path, journal):
+    store = PointStore(LABELS)
+    journal.load(store)
+    return store
+
+
+def as_rows(store):
+    return sorted(zip(*(column.tolist() for column in store.columns())))
+
+
+def test_replay_restores_edits(tmp_path):
+    csv_path = tmp_path / "image.csv"
+    journal = AnnotationJournal(csv_path, LABELS)
+    journal.append(ChangeSet(added=[(1, 10, 10, 0), (2, 20, 20, 1), (3, 30, 30, 0)]))
+    journal.append(ChangeSet(removed=[3], moved=[(1, 11, 12)], relabeled=[(2, 0)]))
+    journal.close()
+
+    store = load(csv_path, AnnotationJournal(csv_path, LABELS))
+
+    assert as_rows(store) == [(1, 11, 12, 0), (2, 20, 20, 0)]
+
+
+def test_replay_skips_torn_record(tmp_path):
+    csv_path = tmp_path / "image.csv"
+    journal = AnnotationJournal(csv_path, LABELS)
+    journal.append(ChangeSet(added=[(1, 10, 10, 0)]))
+    journal.close()
+    with open(journal.path, "a", encoding="utf-8") as journal_file:
+        journal_file.write("a,2,20")
+
+    journal = AnnotationJournal(csv_path, LABELS)
+    journal.append(ChangeSet(added=[(3, 30, 30, 1)]))
+    journal.close()
+
+    store = load(csv_path, AnnotationJournal(csv_path, LABELS))
+
+    assert as_rows(store) == [(1, 10, 10, 0), (3, 30, 30, 1)]
+
+
+def test_compact_writes_snapshot(tmp_path):
+    csv_path = tmp_path / "image.csv"
+    journal = AnnotationJournal(csv_path, LABELS)
+    journal.append(ChangeSet(added=[(1, 10, 10, 0), (2, 20, 20, 1)]))
+
+    journal.compact(background=False)
+    journal.append(ChangeSet(removed=[1]))
+    journal.close()
+
+    assert not os.path.exists(journal.old_path)
+    assert as_rows(load(csv_path, AnnotationJournal(csv_path, LABELS))) == [(2, 20, 20, 1)]
+
+
+def test_append_after_journal_deleted(tmp_path):
+    csv_path = tmp_path / "image.csv"
+    journal = open_journal(csv_path, LABELS)
+    journal.append(ChangeSet(added=[(1, 10, 10, 0)]))
+    os.remove(journal.path)
+
+    journal.append(ChangeSet(added=[(2, 20, 20, 1)]))
+
+    assert as_rows(load(csv_path, AnnotationJournal(csv_path, LABELS))) == [(2, 20, 20, 1)]
+    close_journal(csv_path)
+    assert open_journal(csv_path, LABELS) is not journal
+    close_journal(csv_path)
+
+
+def test_compact_keeps_edits_of_every_session(tmp_path):
+    csv_path = tmp_path / "image.csv"
+    journal = AnnotationJournal(csv_path, LABELS)
+    journal.append(ChangeSet(added=[(1, 10, 10, 0)]))
+    journal.compact(background=False)
+
+    # Another session edits the image: the snapshot is built from the files
+    journal.append(ChangeSet(added=[(2, 20, 20, 1)], moved=[(1, 11, 11)]))
+    journal.compact(background=False)
+    journal.close()
+
+    assert not os.path.exists(journal.path)
+    assert as_rows(load(csv_path, AnnotationJournal(csv_path, LABELS))) == [(1, 11, 11, 0), (2, 20, 20, 1)]
+
+
+def test_diffed_add_is_journaled_with_its_id(tmp_path):
+    csv_path = tmp_path / "image.csv"
+    journal = AnnotationJournal(csv_path, LABELS)
+    store = PointStore(LABELS)
+    store.add(10, 10, 0)
+
+    # A patch without ids is diffed by coordinates
+    changes = diff_points([
+        {'point': [10, 10], 'label_id': 0},
+        {'point': [30, 30], 'label_id': 1},
+    ], store)
+    apply_changes(changes, store)
+    journal.append(changes)
+    journal.close()
+
+    assert changes.added == [(2, 30, 30, 1)]
+    assert as_rows(load(csv_path, AnnotationJournal(csv_path, LABELS))) == [(2, 30, 30, 1)]
+
+
+def test_reserved_ids_never_overlap(tmp_path):
+    csv_path = tmp_path / "image.csv"
+    journal = AnnotationJournal(csv_path, LABELS)
+    journal.append(ChangeSet(added=[(1, 10, 10, 0), (2, 20, 20, 1)]))
+    journal.close()
+
+    journal = AnnotationJournal(csv_path, LABELS)
+    first = journal.reserve_ids(10)
+    journal.append(ChangeSet(added=[(20, 30, 30, 0)]))
+    second = journal.reserve_ids(10)
+    journal.close()
+
+    assert (first, second) == (3, 21)
@@ -0,0 +1,62 @@
+import numpy as np
+import pytest
+from PIL import Image, ImageDraw
+
+from annotation_core import OverlayRenderer, PointStore, apply_ops, stamp_points
+
+LABELS = ["positive", "negative", "other"]
+LABEL_COLORS = {0: (255, 0, 0), 1: (0, 0, 255)}  # Label 2 is drawn white
+
+
+def draw_with_pil(size, xs, ys, labels, radius, width):
+    layer = Image.new("RGBA", size, (0, 0, 0, 0))
+    draw = ImageDraw.Draw(layer)
+    for x, y, label in zip(xs, ys, labels):
+        draw.ellipse(
+            [(x - radius, y - radius), (x + radius, y + radius)],
+            outline=(*LABEL_COLORS.get(label, (255, 255, 255)), 255),
+            width=width,
+        )
+    return np.asarray(layer)
+
+
+def random_points(count, size, seed=0):
+    rng = np.random.default_rng(seed)
+    # Some points fall outside the image, to cover the rings cut by its border
+    xs = rng.integers(-20, size[0] + 20, count)
+    ys = rng.integers(-20, size[1] + 20, count)
+    labels = rng.integers(0, len(LABELS), count)
+    return xs, ys, labels
+
+
+@pytest.mark.parametrize("radius, width", [(4, 2), (8, 3), (15, 9), (30, 5)])
+def test_stamp_points_matches_pil(radius, width):
+    size = (300, 200)
+    xs, ys, labels = random_points(500, size)
+    buffer = np.zeros((size[1], size[0], 4), dtype=np.uint8)
+
+    stamp_points(buffer, xs, ys, labels, LABEL_COLORS, radius, width)
+
+    expected = draw_with_pil(size, xs.tolist(), ys.tolist(), labels.tolist(), radius, width)
+    assert np.array_equal(buffer, expected)
+
+
+def test_overlay_update_matches_redraw():
+    size = (300, 200)
+    store = PointStore(LABELS)
+    store.extend(*random_points(200, size, seed=1))
+    renderer = OverlayRenderer(size, LABEL_COLORS, 8, 3)
+    renderer.redraw(store)
+
+    ids = store.columns()[0].tolist()
+    changes = apply_ops([
+        {'op': 'move', 'id': ids[0], 'point': [5, 5]},
+        {'op': 'relabel', 'id': ids[1], 'label_id': 2},
+        {'op': 'delete', 'id': ids[2]},
+        {'op': 'add', 'id': 1000, 'point': [150, 100], 'label_id': 1},
+    ], store)
+    renderer.update(store, changes)
+
+    expected = OverlayRenderer(size, LABEL_COLORS, 8, 3)
+    expected.redraw(store)
+    assert np.array_equal(np.asarray(renderer.overlay), np.asarray(expected.overlay))
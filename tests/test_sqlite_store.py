@@ -0,0 +1,73 @@
+from annotation_core import AnnotationDatabase, AnnotationJournal, ChangeSet, PointStore, shard_path
+
+LABELS = ["positive", "negative"]
+
+
+def as_rows(store):
+    return sorted(zip(*(column.tolist() for column in store.columns())))
+
+
+def test_points_round_trip(tmp_path):
+    database = AnnotationDatabase(tmp_path / "annotations.sqlite3")
+    store = PointStore(LABELS)
+    store.extend([10, 20, 30], [11, 21, 31], [0, 1, 0])
+
+    database.save_points("her2", "image", store)
+    database.apply_changes("her2", "image", ChangeSet(
+        added=[(9, 40, 41, 1)], removed=[2], moved=[(1, 12, 13)], relabeled=[(3, 1)],
+    ), LABELS)
+
+    loaded = database.load_points("her2", "image", LABELS)
+    assert as_rows(loaded) == [(1, 12, 13, 0), (3, 30, 31, 1), (9, 40, 41, 1)]
+    assert database.label_counts("her2") == {"positive": 1, "negative": 2}
+    assert database.annotated_images() == [("her2", "image", 3)]
+    assert len(database.load_points("ki67", "image", LABELS)) == 0
+
+
+def test_report_round_trip(tmp_path):
+    database = AnnotationDatabase(tmp_path / "annotations.sqlite3")
+
+    database.save_report("her2", "image", "Score: 2+")
+    database.rename_image("her2", "image", "key")
+
+    assert database.load_report("her2", "image") is None
+    assert database.load_report("her2", "key") == "Score: 2+"
+    assert database.has_image("her2", "key")
+
+
+def test_import_csv_tree(tmp_path):
+    ann_dir, report_dir = tmp_path / "annotations", tmp_path / "reports"
+    ann_dir.mkdir()
+    report_dir.mkdir()
+    (ann_dir / "legacy.csv").write_text("X,Y,Label\n1,2,positive\n3,4,negative\n", encoding="utf-8")
+    (report_dir / "legacy.txt").write_text("legacy report", encoding="utf-8")
+
+    csv_path = shard_path(ann_dir, "ab" * 32, ".csv")
+    journal = AnnotationJournal(csv_path, LABELS)
+    journal.append(ChangeSet(added=[(1, 5, 6, 1)]))
+    journal.compact(background=False)
+    journal.append(ChangeSet(added=[(2, 7, 8, 0)]))
+    journal.close()
+
+    database = AnnotationDatabase(tmp_path / "annotations.sqlite3")
+    assert database.import_csv_tree("her2", ann_dir, report_dir) == 2
+
+    assert as_rows(database.load_points("her2", "legacy", LABELS)) == [(1, 1, 2, 0), (2, 3, 4, 1)]
+    assert as_rows(database.load_points("her2", "ab" * 32, LABELS)) == [(1, 5, 6, 1), (2, 7, 8, 0)]
+    assert database.load_report("her2", "legacy") == "legacy report"
+
+
+def test_reserved_point_ids_never_overlap(tmp_path):
+    database = AnnotationDatabase(tmp_path / "annotations.sqlite3")
+    store = PointStore(LABELS)
+    store.extend([10, 20], [11, 21], [0, 1])
+    database.save_points("her2", "image", store)
+
+    # Two sessions on the same image, each with its own block of ids
+    first = database.reserve_point_ids("her2", "image", 10)
+    second = database.reserve_point_ids("her2", "image", 10)
+    database.apply_changes("her2", "image", ChangeSet(added=[(first, 1, 1, 0)]), LABELS)
+    database.apply_changes("her2", "image", ChangeSet(added=[(second, 2, 2, 1)]), LABELS)
+
+    assert (first, second) == (3, 13)
+    assert len(database.load_points("her2", "image", LABELS)) == 4